@@ -6,11 +6,14 @@ for adult, violent, racy, medical, and spoof content using Google Cloud
 Vision API's SafeSearch detection.
 """
 
-import time
+import io
+import hashlib
+from datetime import timedelta
 from enum import Enum
 from typing import Optional
 from dataclasses import dataclass
 
+from PIL import Image
 from google.cloud import vision
 from google.api_core import retry
 from google.api_core.exceptions import GoogleAPIError
@@ -20,10 +23,14 @@ from utils import (
     ContentType,
     get_storage_bucket,
     get_env_var,
+    get_env_int,
+    get_firestore_client,
+    get_timestamp,
     log_moderation_event,
     log_blocked_content,
     increment_user_violations,
 )
+from image_processing import draft_for_size
 
 
 class SafeSearchLikelihood(Enum):
@@ -42,6 +49,47 @@ class SafeSearchLikelihood(Enum):
 # Default threshold: block if LIKELY or higher
 DEFAULT_THRESHOLD = SafeSearchLikelihood.LIKELY
 
+# SafeSearch annotation fields, in the order they are reported
+SAFESEARCH_CATEGORIES = ("adult", "violence", "racy", "medical", "spoof")
+
+# Categories that trigger blocking (medical and spoof are informational)
+BLOCKING_CATEGORIES = ("adult", "violence", "racy")
+
+# Likelihood value -> name, built once instead of per score
+_LIKELIHOOD_NAMES = {level.value: level.name for level in SafeSearchLikelihood}
+
+# Maximum images per Vision batch_annotate_images request
+VISION_BATCH_SIZE = 16
+
+# Retry transient Vision errors with exponential backoff (single layer;
+# callers queue the image if this gives up)
+VISION_RETRY = retry.Retry(
+    predicate=retry.if_transient_error,
+    initial=1.0,  # Initial delay in seconds
+    maximum=10.0,  # Maximum delay
+    multiplier=2.0,  # Exponential multiplier
+    timeout=30.0,  # Total time budget
+)
+
+# Images sent to Vision as bytes are downscaled to this long edge
+DEFAULT_MODERATION_MAX_DIM = 1024
+MODERATION_JPEG_QUALITY = 80
+
+# How long SafeSearch scores are reused for identical image content
+DEFAULT_MODERATION_CACHE_TTL_HOURS = 24
+
+
+# Global Vision client (lazy loaded, reused across warm invocations)
+_vision_client: Optional[vision.ImageAnnotatorClient] = None
+
+
+def get_vision_client() -> vision.ImageAnnotatorClient:
+    """Get or create the global Vision API client."""
+    global _vision_client
+    if _vision_client is None:
+        _vision_client = vision.ImageAnnotatorClient()
+    return _vision_client
+
 
 @dataclass
 class ModerationResult:
@@ -75,80 +123,257 @@ def likelihood_to_enum(likelihood: int) -> SafeSearchLikelihood:
         return SafeSearchLikelihood.UNKNOWN
 
 
-def analyze_image_safesearch(
+def content_hash(image_content: bytes) -> str:
+    """
+    Hash image content for the moderation cache.
+    
+    Uses BLAKE2b (128-bit digest) from the standard library. A
+    cryptographic hash is required: a crafted collision would let an
+    image reuse another image's verdict.
+    
+    Args:
+        image_content: Raw image bytes
+        
+    Returns:
+        Hex digest of the content
+    """
+    return hashlib.blake2b(image_content, digest_size=16).hexdigest()
+
+
+def get_cached_scores(image_hash: str) -> Optional[dict]:
+    """
+    Look up cached SafeSearch scores for identical image content.
+    
+    Args:
+        image_hash: Hash from content_hash
+        
+    Returns:
+        Cached scores dict, or None on a miss, expiry or lookup error
+    """
+    try:
+        db = get_firestore_client()
+        snapshot = db.collection("moderation_cache").document(image_hash).get()
+        if not snapshot.exists:
+            return None
+        
+        entry = snapshot.to_dict()
+        if entry["expiresAt"] <= get_timestamp():
+            return None
+        return entry["scores"]
+    except Exception:
+        # Cache problems should never block moderation
+        return None
+
+
+def cache_scores(image_hash: str, scores: dict) -> None:
+    """
+    Store SafeSearch scores for an image hash.
+    
+    Only raw scores are cached; the threshold is applied on every use
+    so threshold changes take effect immediately.
+    
+    Args:
+        image_hash: Hash from content_hash
+        scores: SafeSearch scores from a successful analysis
+    """
+    ttl_hours = get_env_int("MODERATION_CACHE_TTL_HOURS", DEFAULT_MODERATION_CACHE_TTL_HOURS)
+    now = get_timestamp()
+    
+    try:
+        db = get_firestore_client()
+        db.collection("moderation_cache").document(image_hash).set({
+            "scores": scores,
+            "timestamp": now,
+            "expiresAt": now + timedelta(hours=ttl_hours),
+        })
+    except Exception as e:
+        print(f"Error writing moderation cache: {e}")
+
+
+def _shrink_for_moderation(
     image_content: bytes,
-    max_retries: int = 3
+    max_dim: Optional[int] = None
+) -> bytes:
+    """
+    Downscale an oversized image before sending it to Vision.
+    
+    SafeSearch does not need full resolution, so images whose long edge
+    exceeds max_dim are resized and re-encoded as JPEG. JPEGs are decoded
+    at a reduced scale rather than in full. Smaller or undecodable images
+    are returned unchanged.
+    
+    Args:
+        image_content: Raw image bytes
+        max_dim: Maximum long edge in pixels (MODERATION_MAX_DIM env var)
+        
+    Returns:
+        Image bytes to send to Vision
+    """
+    if max_dim is None:
+        max_dim = get_env_int("MODERATION_MAX_DIM", DEFAULT_MODERATION_MAX_DIM)
+    
+    try:
+        img = Image.open(io.BytesIO(image_content))
+        if max(img.size) <= max_dim:
+            return image_content
+        
+        # Only decode as much of a JPEG as the thumbnail needs
+        scale = max_dim / max(img.size)
+        draft_for_size(img, (round(img.width * scale), round(img.height * scale)))
+        
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+        
+        output = io.BytesIO()
+        img.save(output, format='JPEG', quality=MODERATION_JPEG_QUALITY)
+        return output.getvalue()
+    except Exception:
+        # Let Vision handle anything PIL cannot read
+        return image_content
+
+
+def analyze_image_safesearch(
+    image_content: bytes
 ) -> tuple[dict, Optional[str]]:
     """
     Analyze image content using Google Cloud Vision SafeSearch.
     
+    Transient failures are retried by VISION_RETRY; anything left
+    after that is reported as an error so the image gets queued.
+    
     Args:
         image_content: Raw image bytes
-        max_retries: Maximum number of retry attempts
         
     Returns:
         Tuple of (scores dict, error message or None)
     """
-    client = vision.ImageAnnotatorClient()
+    client = get_vision_client()
     image = vision.Image(content=image_content)
     
-    # Configure retry with exponential backoff
-    retry_config = retry.Retry(
-        initial=1.0,  # Initial delay in seconds
-        maximum=30.0,  # Maximum delay
-        multiplier=2.0,  # Exponential multiplier
-        deadline=60.0,  # Total timeout
-    )
+    try:
+        response = client.safe_search_detection(
+            image=image,
+            retry=VISION_RETRY
+        )
+    except GoogleAPIError as e:
+        return {}, f"Vision API failed: {str(e)}"
+    except Exception as e:
+        return {}, f"Unexpected error during image analysis: {str(e)}"
+    
+    if response.error.message:
+        return {}, f"Vision API error: {response.error.message}"
     
-    for attempt in range(max_retries):
+    return _safesearch_to_scores(response.safe_search_annotation), None
+
+
+def analyze_images_safesearch_batch(
+    gcs_uris: list[str]
+) -> list[tuple[dict, Optional[str]]]:
+    """
+    Analyze several stored images with batched SafeSearch requests.
+    
+    Images are sent in chunks of VISION_BATCH_SIZE per
+    batch_annotate_images call. A failed chunk reports the error for
+    each of its images so they can be queued again; so does a chunk
+    whose response count doesn't match its request count, since the
+    responses can't then be matched to images.
+    
+    Args:
+        gcs_uris: Cloud Storage URIs of the images (gs://bucket/path)
+        
+    Returns:
+        List of (scores dict, error message or None), in input order
+    """
+    client = get_vision_client()
+    feature = vision.Feature(type_=vision.Feature.Type.SAFE_SEARCH_DETECTION)
+    
+    results = []
+    
+    for start in range(0, len(gcs_uris), VISION_BATCH_SIZE):
+        chunk = gcs_uris[start:start + VISION_BATCH_SIZE]
+        requests = [
+            vision.AnnotateImageRequest(
+                image=vision.Image(source=vision.ImageSource(image_uri=uri)),
+                features=[feature],
+            )
+            for uri in chunk
+        ]
+        
         try:
-            response = client.safe_search_detection(
-                image=image,
-                retry=retry_config
+            batch = client.batch_annotate_images(
+                requests=requests,
+                retry=VISION_RETRY
             )
-            
-            if response.error.message:
-                return {}, f"Vision API error: {response.error.message}"
-            
-            safe_search = response.safe_search_annotation
-            
-            # Convert to dictionary with likelihood values
-            scores = {
-                "adult": {
-                    "likelihood": safe_search.adult,
-                    "name": SafeSearchLikelihood(safe_search.adult).name
-                },
-                "violence": {
-                    "likelihood": safe_search.violence,
-                    "name": SafeSearchLikelihood(safe_search.violence).name
-                },
-                "racy": {
-                    "likelihood": safe_search.racy,
-                    "name": SafeSearchLikelihood(safe_search.racy).name
-                },
-                "medical": {
-                    "likelihood": safe_search.medical,
-                    "name": SafeSearchLikelihood(safe_search.medical).name
-                },
-                "spoof": {
-                    "likelihood": safe_search.spoof,
-                    "name": SafeSearchLikelihood(safe_search.spoof).name
-                },
-            }
-            
-            return scores, None
-            
         except GoogleAPIError as e:
-            if attempt < max_retries - 1:
-                # Exponential backoff
-                wait_time = (2 ** attempt) * 1.0
-                time.sleep(wait_time)
-                continue
-            return {}, f"Vision API failed after {max_retries} attempts: {str(e)}"
+            results.extend([({}, f"Vision API batch failed: {str(e)}")] * len(chunk))
+            continue
         except Exception as e:
-            return {}, f"Unexpected error during image analysis: {str(e)}"
+            results.extend(
+                [({}, f"Unexpected error during image analysis: {str(e)}")] * len(chunk)
+            )
+            continue
+        
+        if len(batch.responses) != len(chunk):
+            error = (f"Vision API returned {len(batch.responses)} responses "
+                     f"for {len(chunk)} images")
+            results.extend([({}, error)] * len(chunk))
+            continue
+        
+        for response in batch.responses:
+            if response.error.message:
+                results.append(({}, f"Vision API error: {response.error.message}"))
+            else:
+                results.append((_safesearch_to_scores(response.safe_search_annotation), None))
     
-    return {}, "Max retries exceeded"
+    return results
+
+
+def _safesearch_to_scores(safe_search) -> dict:
+    """
+    Convert a SafeSearch annotation to a scores dictionary.
+    
+    Args:
+        safe_search: SafeSearchAnnotation from a Vision response
+        
+    Returns:
+        Dictionary of category -> likelihood value and name
+    """
+    scores = {}
+    for category in SAFESEARCH_CATEGORIES:
+        likelihood = getattr(safe_search, category)
+        scores[category] = {
+            "likelihood": likelihood,
+            "name": _LIKELIHOOD_NAMES.get(likelihood, "UNKNOWN")
+        }
+    return scores
+
+
+def is_blocked(
+    scores: dict,
+    threshold: SafeSearchLikelihood = None
+) -> bool:
+    """
+    Check whether SafeSearch scores should block an image.
+    
+    Stops at the first flagged category. evaluate_safesearch_scores uses
+    it to approve clean images without building the flagged list.
+    
+    Args:
+        scores: SafeSearch scores from analyze_image_safesearch
+        threshold: Minimum likelihood level to trigger blocking
+        
+    Returns:
+        True if any blocking category is at or above threshold
+    """
+    if threshold is None:
+        threshold = get_moderation_threshold()
+    
+    threshold_value = threshold.value
+    return any(
+        category in scores and scores[category]["likelihood"] >= threshold_value
+        for category in BLOCKING_CATEGORIES
+    )
 
 
 def evaluate_safesearch_scores(
@@ -172,35 +397,28 @@ def evaluate_safesearch_scores(
     if threshold is None:
         threshold = get_moderation_threshold()
     
-    # Categories that trigger blocking
-    blocking_categories = ["adult", "violence", "racy"]
-    
-    flagged_categories = []
-    
-    for category in blocking_categories:
-        if category in scores:
-            likelihood = scores[category]["likelihood"]
-            if likelihood >= threshold.value:
-                flagged_categories.append(category)
-    
-    if flagged_categories:
-        reason = f"Content flagged for: {', '.join(flagged_categories)}"
+    # Most images are clean; approve those without listing categories
+    if not is_blocked(scores, threshold):
         return ModerationResult(
-            allowed=False,
-            action=ModerationAction.BLOCKED,
-            reason=reason,
+            allowed=True,
+            action=ModerationAction.APPROVED,
+            reason="Content passed moderation",
             scores=scores,
-            categories_flagged=flagged_categories
+            categories_flagged=[]
         )
-        
-        
     
+    threshold_value = threshold.value
+    flagged_categories = [
+        category for category in BLOCKING_CATEGORIES
+        if category in scores and scores[category]["likelihood"] >= threshold_value
+    ]
+    reason = f"Content flagged for: {', '.join(flagged_categories)}"
     return ModerationResult(
-        allowed=True,
-        action=ModerationAction.APPROVED,
-        reason="Content passed moderation",
+        allowed=False,
+        action=ModerationAction.BLOCKED,
+        reason=reason,
         scores=scores,
-        categories_flagged=[]
+        categories_flagged=flagged_categories
     )
 
 
@@ -213,13 +431,16 @@ def moderate_image(
     """
     Full image moderation pipeline.
     
-    1. Analyze image with Vision API SafeSearch
+    1. Analyze image with Vision API SafeSearch (or reuse cached
+       scores for identical content)
     2. Evaluate against threshold
     3. Log the result
     4. Handle violations
     
     Args:
-        image_content: Raw image bytes
+        image_content: Raw image bytes. Vision scores these bytes
+            (downscaled first if oversized) and the scores are cached
+            under the hash of the original bytes.
         user_id: ID of the uploading user
         image_path: Storage path of the image
         image_id: Unique image identifier
@@ -227,9 +448,65 @@ def moderate_image(
     Returns:
         ModerationResult with decision and details
     """
-    # Analyze the image
-    scores, error = analyze_image_safesearch(image_content)
+    image_hash = content_hash(image_content)
+    scores = get_cached_scores(image_hash)
+    error = None
+    
+    # Analyze the image on a cache miss
+    if scores is None:
+        scores, error = analyze_image_safesearch(_shrink_for_moderation(image_content))
+        if not error:
+            cache_scores(image_hash, scores)
+    
+    return _apply_moderation(scores, error, user_id, image_path, image_id)
+
+
+def moderate_images_batch(
+    images: list[tuple[str, str, str]],
+    bucket_name: str
+) -> list[ModerationResult]:
+    """
+    Moderate several stored images using batched Vision requests.
+    
+    Vision reads the objects from storage, so only use this for paths
+    users can't overwrite (queued/); the scores aren't cached.
+    
+    Args:
+        images: List of (user_id, image_path, image_id) tuples
+        bucket_name: Bucket holding the images
+        
+    Returns:
+        List of ModerationResult, in input order
+    """
+    gcs_uris = [f"gs://{bucket_name}/{image_path}" for _, image_path, _ in images]
+    analyses = analyze_images_safesearch_batch(gcs_uris)
+    
+    return [
+        _apply_moderation(scores, error, user_id, image_path, image_id)
+        for (user_id, image_path, image_id), (scores, error) in zip(images, analyses)
+    ]
+
+
+def _apply_moderation(
+    scores: dict,
+    error: Optional[str],
+    user_id: str,
+    image_path: str,
+    image_id: str
+) -> ModerationResult:
+    """
+    Evaluate SafeSearch output, log the result and handle violations.
     
+    Args:
+        scores: SafeSearch scores (empty on error)
+        error: Error message from the analysis, or None
+        user_id: ID of the uploading user
+        image_path: Storage path of the image
+        image_id: Unique image identifier
+        
+    Returns:
+        ModerationResult with decision and details
+    """
     if error:
         # API failure - queue for later
         log_moderation_event(
@@ -283,7 +560,8 @@ def move_image_to_approved(
     source_path: str,
     user_id: str,
     image_id: str,
-    bucket_name: Optional[str] = None
+    bucket_name: Optional[str] = None,
+    source_generation: Optional[int] = None
 ) -> str:
     """
     Move an approved image from pending to approved folder.
@@ -293,17 +571,20 @@ def move_image_to_approved(
         user_id: User ID
         image_id: Image ID
         bucket_name: Optional bucket name
+        source_generation: Optional object generation to move; set it to
+            the generation that triggered processing, so a later overwrite
+            of the same path is never moved
         
     Returns:
         New storage path in approved/
     """
     bucket = get_storage_bucket(bucket_name)
     
-    source_blob = bucket.blob(source_path.lstrip('/'))
+    source_blob = bucket.blob(source_path.lstrip('/'), generation=source_generation)
     dest_path = f"approved/{user_id}/{image_id}"
     
     # Copy to new location
-    bucket.copy_blob(source_blob, bucket, dest_path)
+    bucket.copy_blob(source_blob, bucket, dest_path, source_generation=source_generation)
     
     # Delete from pending
     source_blob.delete()
@@ -315,7 +596,8 @@ def move_image_to_queued(
     source_path: str,
     user_id: str,
     image_id: str,
-    bucket_name: Optional[str] = None
+    bucket_name: Optional[str] = None,
+    source_generation: Optional[int] = None
 ) -> str:
     """
     Move an image to queued folder for later processing.
@@ -325,17 +607,20 @@ def move_image_to_queued(
         user_id: User ID
         image_id: Image ID
         bucket_name: Optional bucket name
+        source_generation: Optional object generation to move; set it to
+            the generation that triggered processing, so a later overwrite
+            of the same path is never moved
         
     Returns:
         New storage path in queued/
     """
     bucket = get_storage_bucket(bucket_name)
     
-    source_blob = bucket.blob(source_path.lstrip('/'))
+    source_blob = bucket.blob(source_path.lstrip('/'), generation=source_generation)
     dest_path = f"queued/{user_id}/{image_id}"
     
     # Copy to queued location
-    bucket.copy_blob(source_blob, bucket, dest_path)
+    bucket.copy_blob(source_blob, bucket, dest_path, source_generation=source_generation)
     
     # Delete from pending
     source_blob.delete()
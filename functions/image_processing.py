@@ -8,10 +8,12 @@ This module handles post-moderation image processing:
 """
 
 import io
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Union
 from dataclasses import dataclass
 
+import numpy as np
 from PIL import Image
+from google.cloud.storage import transfer_manager
 
 from utils import get_storage_bucket, get_env_int
 
@@ -22,6 +24,12 @@ DEFAULT_COMPRESSED_MAX_SIZE = (1920, 1920)  # Max dimension for compressed
 DEFAULT_JPEG_QUALITY = 85
 DEFAULT_THUMBNAIL_QUALITY = 75
 
+# JPEGs at or below this size that already fit are stored as uploaded
+PASSTHROUGH_MAX_BYTES = 500 * 1024
+
+# Image.info entries that can carry location, device or editing details
+METADATA_INFO_KEYS = ('exif', 'xmp', 'icc_profile', 'comment')
+
 
 @dataclass
 class ProcessedImage:
@@ -66,16 +74,78 @@ def should_use_png(image: Image.Image) -> bool:
     if image.mode in ('RGBA', 'LA', 'PA'):
         # Check if there's actual transparency
         if image.mode == 'RGBA':
-            alpha = image.getchannel('A')
+            alpha = np.asarray(image.getchannel('A'))
             # If all pixels are fully opaque, no need for PNG
-            if alpha.getextrema() == (255, 255):
-                return False
-            return True
+            return bool(alpha.min() < 255)
     return False
 
 
-def compress_image(
+def draft_for_size(image: Image.Image, size: Tuple[int, int]) -> None:
+    """
+    Enable JPEG shrink-on-load for a target size.
+    
+    JPEG can be decoded directly at 1/2, 1/4 or 1/8 scale, skipping most
+    of the IDCT work. The decoder picks the smallest scale that still
+    covers the requested size, so no upscaling is ever needed. Must be
+    called before the image is loaded; other formats are left alone.
+    
+    Args:
+        image: PIL Image object (not yet loaded)
+        size: Smallest acceptable (width, height) after decoding
+    """
+    if image.format == 'JPEG':
+        image.draft('RGB', size)
+
+
+def can_pass_through(
+    image: Image.Image,
     image_content: bytes,
+    max_dimension: Tuple[int, int] = DEFAULT_COMPRESSED_MAX_SIZE
+) -> bool:
+    """
+    Determine if an image can be stored without re-encoding.
+    
+    Small RGB/greyscale JPEGs that already fit within max_dimension gain
+    nothing from recompression. Images carrying comment metadata or any
+    APPn segment besides the JFIF header (EXIF, XMP, ICC, Photoshop/IPTC,
+    ...) are always re-encoded so that details such as GPS location or
+    author are stripped.
+    
+    Args:
+        image: PIL Image object
+        image_content: Raw image bytes
+        max_dimension: Maximum width/height
+        
+    Returns:
+        True if the original bytes can be used as the compressed version
+    """
+    return (
+        image.format == 'JPEG'
+        and image.mode in ('RGB', 'L')
+        and not any(key in image.info for key in METADATA_INFO_KEYS)
+        and all(
+            marker == 'APP0' and data.startswith(b'JFIF\0')
+            for marker, data in getattr(image, 'applist', ())
+        )
+        and len(image_content) <= PASSTHROUGH_MAX_BYTES
+        and image.width <= max_dimension[0]
+        and image.height <= max_dimension[1]
+    )
+
+
+def _strip_metadata(img: Image.Image) -> None:
+    """
+    Drop metadata PIL would otherwise copy into a re-encoded image.
+    
+    Pillow writes a decoded JPEG's comment (and a PNG's ICC profile)
+    back out on save unless it is removed from img.info.
+    """
+    for key in METADATA_INFO_KEYS:
+        img.info.pop(key, None)
+
+
+def compress_image(
+    image_content: Union[bytes, Image.Image],
     max_dimension: Tuple[int, int] = DEFAULT_COMPRESSED_MAX_SIZE,
     quality: int = DEFAULT_JPEG_QUALITY
 ) -> Tuple[bytes, str, Tuple[int, int]]:
@@ -83,17 +153,34 @@ def compress_image(
     Compress an image while maintaining quality.
     
     Args:
-        image_content: Raw image bytes
+        image_content: Raw image bytes or an already decoded PIL Image
+            (which may be modified in place)
         max_dimension: Maximum width/height
         quality: JPEG quality (1-100)
         
     Returns:
         Tuple of (compressed bytes, format, new size)
     """
-    # Open image
-    img = Image.open(io.BytesIO(image_content))
-    original_size = img.size
+    if isinstance(image_content, bytes):
+        image_content = Image.open(io.BytesIO(image_content))
+        draft_for_size(image_content, max_dimension)
+    compressed_bytes, format_used, img = _compress_from_img(
+        image_content, max_dimension, quality
+    )
+    return compressed_bytes, format_used, img.size
+
+
+def _compress_from_img(
+    img: Image.Image,
+    max_dimension: Tuple[int, int],
+    quality: int
+) -> Tuple[bytes, str, Image.Image]:
+    """
+    Compress a decoded image. See compress_image.
     
+    Returns the resized image instead of its size so callers can
+    derive further outputs from it.
+    """
     # Convert to RGB if necessary (for JPEG)
     use_png = should_use_png(img)
     
@@ -105,6 +192,7 @@ def compress_image(
         img.thumbnail(max_dimension, Image.Resampling.LANCZOS)
     
     # Save to bytes
+    _strip_metadata(img)
     output = io.BytesIO()
     
     if use_png:
@@ -114,12 +202,11 @@ def compress_image(
         img.save(output, format='JPEG', quality=quality, optimize=True)
         format_used = 'JPEG'
     
-    output.seek(0)
-    return output.read(), format_used, img.size
+    return output.getvalue(), format_used, img
 
 
 def generate_thumbnail(
-    image_content: bytes,
+    image_content: Union[bytes, Image.Image],
     size: Tuple[int, int] = DEFAULT_THUMBNAIL_SIZE,
     quality: int = DEFAULT_THUMBNAIL_QUALITY
 ) -> Tuple[bytes, Tuple[int, int]]:
@@ -127,16 +214,27 @@ def generate_thumbnail(
     Generate a thumbnail from an image.
     
     Args:
-        image_content: Raw image bytes
+        image_content: Raw image bytes or an already decoded PIL Image
+            (which may be modified in place)
         size: Thumbnail size (width, height)
         quality: JPEG quality for thumbnail
         
     Returns:
         Tuple of (thumbnail bytes, actual size)
     """
-    # Open image
-    img = Image.open(io.BytesIO(image_content))
-    
+    if isinstance(image_content, bytes):
+        image_content = Image.open(io.BytesIO(image_content))
+        # Decode at >= 2x the target so LANCZOS still has detail to work with
+        draft_for_size(image_content, (size[0] * 2, size[1] * 2))
+    return _thumbnail_from_img(image_content, size, quality)
+
+
+def _thumbnail_from_img(
+    img: Image.Image,
+    size: Tuple[int, int],
+    quality: int
+) -> Tuple[bytes, Tuple[int, int]]:
+    """Generate a thumbnail from a decoded image. See generate_thumbnail."""
     # Convert to RGB if necessary
     if img.mode not in ('RGB', 'L'):
         img = img.convert('RGB')
@@ -144,12 +242,14 @@ def generate_thumbnail(
     # Create thumbnail (maintains aspect ratio)
     img.thumbnail(size, Image.Resampling.LANCZOS)
     
-    # Save to bytes as JPEG
+    # Save to bytes as JPEG. Huffman optimisation saves well under 1KB at
+    # thumbnail size but triples encode time, so use a single pass.
+    # Metadata is stripped first so none of it is carried over.
+    _strip_metadata(img)
     output = io.BytesIO()
-    img.save(output, format='JPEG', quality=quality, optimize=True)
-    output.seek(0)
+    img.save(output, format='JPEG', quality=quality, optimize=False, progressive=False)
     
-    return output.read(), img.size
+    return output.getvalue(), img.size
 
 
 def process_approved_image(
@@ -162,6 +262,11 @@ def process_approved_image(
     """
     Process an approved image: compress and generate thumbnail.
     
+    The image is decoded once; the thumbnail is derived from the
+    already downscaled compressed image rather than the original.
+    Decoded pixel buffers are released as each stage finishes to keep
+    peak memory down on large uploads.
+    
     Args:
         image_content: Raw image bytes
         thumbnail_size: Size for thumbnail
@@ -172,24 +277,41 @@ def process_approved_image(
     Returns:
         ProcessedImage with all versions
     """
-    # Get original info
+    # Decode once and get original info
     original_img = Image.open(io.BytesIO(image_content))
     original_format = get_image_format(original_img)
     original_size = original_img.size
     
-    # Compress
-    compressed_bytes, compressed_format, compressed_size = compress_image(
-        image_content,
-        max_compressed_size,
-        jpeg_quality
-    )
+    # Check the stored size before shrink-on-load can shrink the decode
+    passthrough = can_pass_through(original_img, image_content, max_compressed_size)
+    if not passthrough:
+        draft_for_size(original_img, max_compressed_size)
+    original_img.load()
     
-    # Generate thumbnail
-    thumbnail_bytes, thumbnail_size_actual = generate_thumbnail(
-        image_content,
+    # Compress, unless the original is already a compliant JPEG
+    if passthrough:
+        compressed_bytes, compressed_format, compressed_img = (
+            image_content, 'JPEG', original_img
+        )
+    else:
+        compressed_bytes, compressed_format, compressed_img = _compress_from_img(
+            original_img,
+            max_compressed_size,
+            jpeg_quality
+        )
+    compressed_size = compressed_img.size
+    
+    # Release the full-size pixels as soon as they are no longer needed
+    if compressed_img is not original_img:
+        original_img.close()
+    
+    # Generate thumbnail from the smaller compressed image
+    thumbnail_bytes, thumbnail_size_actual = _thumbnail_from_img(
+        compressed_img,
         thumbnail_size,
         thumbnail_quality
     )
+    compressed_img.close()
     
     return ProcessedImage(
         original_bytes=image_content,
@@ -207,16 +329,25 @@ def upload_processed_images(
     processed: ProcessedImage,
     user_id: str,
     image_id: str,
-    bucket_name: Optional[str] = None
+    bucket_name: Optional[str] = None,
+    source_path: Optional[str] = None,
+    source_generation: Optional[int] = None
 ) -> dict:
     """
     Upload processed images to Firebase Storage.
     
+    When the compressed version is the unmodified original and the
+    source object is given with its generation, it is copied server-side
+    instead of uploaded. The generation pins the copy to the bytes that
+    were moderated, even if the path has been overwritten since.
+    
     Args:
         processed: ProcessedImage object with all versions
         user_id: User ID
         image_id: Image ID
         bucket_name: Optional bucket name
+        source_path: Optional storage path of the original image
+        source_generation: Generation of source_path that was processed
         
     Returns:
         Dictionary with paths to all uploaded versions
@@ -229,20 +360,34 @@ def upload_processed_images(
     # Strip existing extension from image_id if present
     base_image_id = image_id.rsplit('.', 1)[0] if '.' in image_id else image_id
     
-    # Upload compressed version to /approved/
     approved_path = f"approved/{user_id}/{base_image_id}.{compressed_ext}"
     approved_blob = bucket.blob(approved_path)
-    approved_blob.upload_from_string(
-        processed.compressed_bytes,
-        content_type=f"image/{compressed_ext}"
-    )
-    
-    # Upload thumbnail to /thumbnails/
     thumbnail_path = f"thumbnails/{user_id}/{base_image_id}.jpg"
     thumbnail_blob = bucket.blob(thumbnail_path)
-    thumbnail_blob.upload_from_string(
-        processed.thumbnail_bytes,
-        content_type="image/jpeg"
+    
+    uploads = []
+    
+    # Compressed version to /approved/ (copied server-side if unmodified)
+    passthrough = processed.compressed_bytes is processed.original_bytes
+    if passthrough and source_path and source_generation is not None:
+        bucket.copy_blob(
+            bucket.blob(source_path.lstrip('/')), bucket, approved_path,
+            source_generation=source_generation
+        )
+    else:
+        approved_blob.content_type = f"image/{compressed_ext}"
+        uploads.append((io.BytesIO(processed.compressed_bytes), approved_blob))
+    
+    # Thumbnail to /thumbnails/
+    thumbnail_blob.content_type = "image/jpeg"
+    uploads.append((io.BytesIO(processed.thumbnail_bytes), thumbnail_blob))
+    
+    # Upload concurrently; re-raise any upload error
+    transfer_manager.upload_many(
+        uploads,
+        worker_type=transfer_manager.THREAD,
+        max_workers=len(uploads),
+        raise_exception=True
     )
     
     return {
@@ -13,6 +13,8 @@ Functions:
 """
 
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from firebase_functions import https_fn, storage_fn, scheduler_fn, options
 from firebase_admin import auth
 
@@ -26,6 +28,8 @@ from utils import (
 )
 from image_moderation import (
     moderate_image,
+    moderate_images_batch,
+    ModerationResult,
     move_image_to_approved,
     move_image_to_queued,
     delete_blocked_image,
@@ -34,7 +38,7 @@ from image_processing import (
     process_approved_image,
     upload_processed_images,
 )
-from text_moderation import validate_text as validate_text_content
+from text_moderation import validate_text as validate_text_content, get_text_moderator
 from rate_limiter import (
     check_image_upload_limit,
     check_text_message_limit,
@@ -50,6 +54,20 @@ from reporting import (
 # Initialize Firebase on cold start
 initialize_firebase()
 
+# Load the blocklist and build the text matchers during cold start, so the
+# first validate_text request doesn't pay for it. A failure here must not
+# break import for every other function; get_text_moderator() retries on
+# first use.
+try:
+    get_text_moderator()
+except Exception as e:
+    print(f"Error building text moderator at cold start: {e}")
+
+# Worker threads for processing queued images. Each worker holds a full
+# download plus its decoded PIL image, so keep this small enough for the
+# 512MB process_queued_images function.
+QUEUED_WORKERS = 4
+
 
 # ============================================================================
 # IMAGE MODERATION
@@ -67,8 +85,9 @@ def on_image_upload(event: storage_fn.CloudEvent[storage_fn.StorageObjectData]):
     
     Flow:
     1. Check rate limit
-    2. Download image
-    3. Run SafeSearch moderation
+    2. Download the uploaded generation of the image
+    3. Run SafeSearch moderation on exactly those bytes (cached by
+       content hash)
     4. If approved: process image and move to approved folder
     5. If blocked: delete and log
     6. If API fails: queue for later
@@ -76,6 +95,7 @@ def on_image_upload(event: storage_fn.CloudEvent[storage_fn.StorageObjectData]):
     file_path = event.data.name
     bucket_name = event.data.bucket
     content_type = event.data.content_type
+    generation = int(event.data.generation) if event.data.generation else None
     
     # Only process images in pending folder
     if not file_path.startswith("pending/"):
@@ -101,9 +121,11 @@ def on_image_upload(event: storage_fn.CloudEvent[storage_fn.StorageObjectData]):
         delete_blocked_image(file_path, bucket_name)
         return
     
-    # Download the image
+    # Download the image. The uploader can overwrite the pending path, so
+    # pin the generation that triggered this event and only ever check,
+    # copy or publish that version.
     bucket = get_storage_bucket(bucket_name)
-    blob = bucket.blob(file_path)
+    blob = bucket.blob(file_path, generation=generation)
     
     try:
         image_content = blob.download_as_bytes()
@@ -111,7 +133,7 @@ def on_image_upload(event: storage_fn.CloudEvent[storage_fn.StorageObjectData]):
         print(f"Error downloading image: {e}")
         return
     
-    # Run moderation
+    # Run moderation on the downloaded bytes (what gets published)
     result = moderate_image(
         image_content=image_content,
         user_id=user_id,
@@ -129,7 +151,9 @@ def on_image_upload(event: storage_fn.CloudEvent[storage_fn.StorageObjectData]):
                 processed=processed,
                 user_id=user_id,
                 image_id=image_id,
-                bucket_name=bucket_name
+                bucket_name=bucket_name,
+                source_path=file_path,
+                source_generation=generation
             )
             
             # Delete from pending
@@ -141,7 +165,10 @@ def on_image_upload(event: storage_fn.CloudEvent[storage_fn.StorageObjectData]):
             print(f"Error processing approved image: {e}")
             # Move to approved anyway (without processing)
             try:
-                move_image_to_approved(file_path, user_id, image_id, bucket_name)
+                move_image_to_approved(
+                    file_path, user_id, image_id, bucket_name,
+                    source_generation=generation
+                )
             except Exception as move_error:
                 print(f"Error moving to approved: {move_error}")
     
@@ -153,7 +180,10 @@ def on_image_upload(event: storage_fn.CloudEvent[storage_fn.StorageObjectData]):
     elif result.action == ModerationAction.QUEUED:
         # Move to queued for later processing
         try:
-            move_image_to_queued(file_path, user_id, image_id, bucket_name)
+            move_image_to_queued(
+                file_path, user_id, image_id, bucket_name,
+                source_generation=generation
+            )
             print(f"Image queued for later: {result.reason}")
         except Exception as e:
             print(f"Error moving to queue: {e}")
@@ -312,6 +342,44 @@ def get_rate_limits(req: https_fn.CallableRequest) -> dict:
 # SCHEDULED FUNCTIONS
 # ============================================================================
 
+def _process_one_queued(
+    blob,
+    user_id: str,
+    image_id: str,
+    result: ModerationResult
+) -> bool:
+    """
+    Apply a moderation result to a single queued image.
+    
+    Returns:
+        True if the image left the queue (approved or blocked)
+    """
+    file_path = blob.name
+    
+    try:
+        if result.action == ModerationAction.APPROVED:
+            # Download, process and move
+            image_content = blob.download_as_bytes()
+            processed_img = process_approved_image(image_content)
+            upload_processed_images(
+                processed_img, user_id, image_id,
+                source_path=file_path, source_generation=blob.generation
+            )
+            blob.delete()
+            return True
+            
+        elif result.action == ModerationAction.BLOCKED:
+            delete_blocked_image(file_path)
+            return True
+            
+        # If still queued (API failed again), leave it for next run
+        
+    except Exception as e:
+        print(f"Error processing queued image {file_path}: {e}")
+    
+    return False
+
+
 @scheduler_fn.on_schedule(
     schedule="every 5 minutes",
     memory=options.MemoryOption.MB_512,
@@ -325,16 +393,14 @@ def process_queued_images(event: scheduler_fn.ScheduledEvent):
     """
     bucket = get_storage_bucket()
     
-    # List all blobs in queued folder
-    blobs = bucket.list_blobs(prefix="queued/")
-    
-    processed = 0
     max_process = 50  # Limit per run
     
+    # List only the first max_process blobs in queued folder
+    blobs = bucket.list_blobs(prefix="queued/", max_results=max_process)
+    
+    # Collect the images to retry this run
+    candidates = []
     for blob in blobs:
-        if processed >= max_process:
-            break
-        
         file_path = blob.name
         
         # Skip if not an image or if it's a folder marker
@@ -346,33 +412,29 @@ def process_queued_images(event: scheduler_fn.ScheduledEvent):
         except ValueError:
             continue
         
-        try:
-            # Download and moderate
-            image_content = blob.download_as_bytes()
-            
-            from image_moderation import moderate_image
-            result = moderate_image(
-                image_content=image_content,
-                user_id=user_id,
-                image_path=file_path,
-                image_id=image_id
-            )
-            
-            if result.action == ModerationAction.APPROVED:
-                # Process and move
-                processed_img = process_approved_image(image_content)
-                upload_processed_images(processed_img, user_id, image_id)
-                blob.delete()
-                processed += 1
-                
-            elif result.action == ModerationAction.BLOCKED:
-                delete_blocked_image(file_path)
-                processed += 1
-                
-            # If still queued (API failed again), leave it for next run
-            
-        except Exception as e:
-            print(f"Error processing queued image {file_path}: {e}")
+        candidates.append((blob, user_id, image_id))
+
+    # Nothing queued; don't create the Vision client for an empty batch
+    if not candidates:
+        return
+
+    # Moderate all candidates with batched Vision requests
+    try:
+        results = moderate_images_batch(
+            [(user_id, blob.name, image_id) for blob, user_id, image_id in candidates],
+            bucket.name
+        )
+    except Exception as e:
+        print(f"Error moderating queued images: {e}")
+        return
+    
+    # Download/process/upload is I/O bound, so overlap it across images
+    with ThreadPoolExecutor(max_workers=QUEUED_WORKERS) as executor:
+        futures = [
+            executor.submit(_process_one_queued, blob, user_id, image_id, result)
+            for (blob, user_id, image_id), result in zip(candidates, results)
+        ]
+        processed = sum(future.result() for future in as_completed(futures))
     
     print(f"Processed {processed} queued images")
 
@@ -2,17 +2,31 @@
 Rate limiting module for preventing abuse and cost spikes.
 
 This module implements per-user rate limiting using Firestore as the
-backing store. It supports configurable limits for different action types.
+backing store, or Redis when REDIS_HOST is configured (see
+redis_rate_limiter). It supports configurable limits for different
+action types.
 """
 
+import functools
+import random
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
 from typing import Optional
 from dataclasses import dataclass
 from enum import Enum
 
 from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition
 
 from utils import get_firestore_client, get_env_int, get_timestamp
+from redis_rate_limiter import (
+    RedisError,
+    get_redis_client,
+    check_window_counter,
+    check_sliding_counter,
+)
 
 
 class RateLimitType(Enum):
@@ -22,14 +36,15 @@ class RateLimitType(Enum):
     REPORT = "report"
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class RateLimitConfig:
     """Configuration for a rate limit."""
     limit: int
     window_seconds: int
+    shards: int = 1  # Firestore counter documents per window
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class RateLimitResult:
     """Result of a rate limit check."""
     allowed: bool
@@ -57,10 +72,63 @@ DEFAULT_RATE_LIMITS = {
 }
 
 
+# Conditional write attempts per check before falling back to a transaction
+RATE_LIMIT_WRITE_ATTEMPTS = 3
+
+
+# Short-lived cache of recent counter values per window key. Only used to
+# deny without a round trip when the window is already known to be full.
+DECISION_CACHE_TTL_SECONDS = 0.5
+DECISION_CACHE_MAX_ENTRIES = 10000
+_decision_cache: OrderedDict[str, tuple[int, float]] = OrderedDict()
+_decision_lock = threading.Lock()
+
+
+def _get_cached_count(doc_key: str) -> Optional[int]:
+    """
+    Get a recently observed count for a window, if still fresh.
+    
+    Args:
+        doc_key: Window key from get_window_key
+        
+    Returns:
+        Cached count, or None if missing or expired
+    """
+    with _decision_lock:
+        entry = _decision_cache.get(doc_key)
+        if entry is None:
+            return None
+        count, observed_at = entry
+        if time.monotonic() - observed_at > DECISION_CACHE_TTL_SECONDS:
+            del _decision_cache[doc_key]
+            return None
+        _decision_cache.move_to_end(doc_key)
+        return count
+
+
+def _remember_count(doc_key: str, count: int) -> None:
+    """
+    Record the latest observed count for a window.
+    
+    Args:
+        doc_key: Window key from get_window_key
+        count: Counter value after the check
+    """
+    with _decision_lock:
+        _decision_cache[doc_key] = (count, time.monotonic())
+        _decision_cache.move_to_end(doc_key)
+        if len(_decision_cache) > DECISION_CACHE_MAX_ENTRIES:
+            _decision_cache.popitem(last=False)
+
+
+@functools.lru_cache(maxsize=8)
 def get_rate_limit_config(limit_type: RateLimitType) -> RateLimitConfig:
     """
     Get rate limit configuration, with environment variable overrides.
     
+    The result is cached per process; environment overrides are read on
+    the first call for each limit type.
+    
     Args:
         limit_type: Type of rate limit
         
@@ -68,19 +136,26 @@ def get_rate_limit_config(limit_type: RateLimitType) -> RateLimitConfig:
         RateLimitConfig for the given type
     """
     defaults = DEFAULT_RATE_LIMITS[limit_type]
+    shards = max(1, get_env_int("RATE_LIMIT_COUNTER_SHARDS", defaults.shards))
     
     if limit_type == RateLimitType.IMAGE_UPLOAD:
         return RateLimitConfig(
             limit=get_env_int("RATE_LIMIT_IMAGES_PER_HOUR", defaults.limit),
-            window_seconds=defaults.window_seconds
+            window_seconds=defaults.window_seconds,
+            shards=shards
         )
     elif limit_type == RateLimitType.TEXT_MESSAGE:
         return RateLimitConfig(
             limit=get_env_int("RATE_LIMIT_TEXTS_PER_MINUTE", defaults.limit),
-            window_seconds=defaults.window_seconds
+            window_seconds=defaults.window_seconds,
+            shards=shards
         )
     
-    return defaults
+    return RateLimitConfig(
+        limit=defaults.limit,
+        window_seconds=defaults.window_seconds,
+        shards=shards
+    )
 
 
 def get_window_key(user_id: str, limit_type: RateLimitType, window_seconds: int) -> str:
@@ -101,6 +176,105 @@ def get_window_key(user_id: str, limit_type: RateLimitType, window_seconds: int)
     return f"{user_id}_{limit_type.value}_{window_start}"
 
 
+def _shard_keys(doc_key: str, shards: int) -> list[str]:
+    """
+    Get the counter document keys for a window.
+    
+    Args:
+        doc_key: Window key from get_window_key
+        shards: Number of counter shards
+        
+    Returns:
+        The window key itself when unsharded, otherwise one key per shard
+    """
+    if shards <= 1:
+        return [doc_key]
+    return [f"{doc_key}_{i}" for i in range(shards)]
+
+
+def _check_sharded_counter(
+    db,
+    doc_key: str,
+    config: RateLimitConfig,
+    data: Optional[dict]
+) -> tuple[int, bool]:
+    """
+    Check and optionally increment a sharded Firestore window counter.
+    
+    The count is the sum over all shards, read in one batched get. An
+    allowed increment goes to a random shard so a hot user's writes are
+    spread across documents instead of hitting one document's write rate.
+    
+    The total is read outside any transaction and the increment is a blind
+    Increment(1), so requests no longer contend on a single document. The
+    price is a small overshoot: checks for the same window that all read
+    before any of them writes are all admitted, so the count can pass the
+    limit by at most the number of such concurrent checks minus one. Once
+    a read sees the limit, every later check is denied.
+    
+    Args:
+        db: Firestore client
+        doc_key: Window key from get_window_key
+        config: Rate limit configuration (with shards > 1)
+        data: Fields to merge into the chosen shard, or None to only read
+        
+    Returns:
+        Tuple of (current count, allowed)
+    """
+    refs = [
+        db.collection("rate_limits").document(key)
+        for key in _shard_keys(doc_key, config.shards)
+    ]
+    current_count = sum(
+        snapshot.get("count") or 0
+        for snapshot in db.get_all(refs)
+        if snapshot.exists
+    )
+    
+    if current_count >= config.limit:
+        return current_count, False
+    if data is None:
+        return current_count, True
+    
+    random.choice(refs).set(data, merge=True)
+    return current_count + 1, True
+
+
+def _increment_in_transaction(
+    db,
+    doc_ref,
+    data: dict,
+    limit: int
+) -> tuple[int, bool]:
+    """
+    Check and increment a window counter inside a Firestore transaction.
+    
+    Used once the optimistic writes keep losing races, so a user under
+    their limit is still admitted under contention. Firestore retries
+    the transaction itself on conflicts.
+    
+    Args:
+        db: Firestore client
+        doc_ref: Window counter document
+        data: Fields to merge, including the count Increment
+        limit: Maximum count allowed in the window
+        
+    Returns:
+        Tuple of (current count, allowed)
+    """
+    @firestore.transactional
+    def check_in_transaction(transaction):
+        snapshot = doc_ref.get(transaction=transaction)
+        current_count = (snapshot.get("count") or 0) if snapshot.exists else 0
+        if current_count >= limit:
+            return current_count, False
+        
+        transaction.set(doc_ref, data, merge=True)
+        return current_count + 1, True
+    
+    return check_in_transaction(db.transaction())
+
+
 def check_rate_limit(
     user_id: str,
     limit_type: RateLimitType,
@@ -117,7 +291,6 @@ def check_rate_limit(
     Returns:
         RateLimitResult with decision and details
     """
-    db = get_firestore_client()
     config = get_rate_limit_config(limit_type)
     
     now = get_timestamp()
@@ -125,87 +298,179 @@ def check_rate_limit(
     window_start = datetime.fromtimestamp(window_start_ts, tz=timezone.utc)
     window_end = window_start + timedelta(seconds=config.window_seconds)
     
-    # Document key includes user, type, and window
-    doc_key = get_window_key(user_id, limit_type, config.window_seconds)
-    doc_ref = db.collection("rate_limits").document(doc_key)
+    # Document key includes user, type, and window (same format as
+    # get_window_key, reusing the window already computed above)
+    limit_type_value = limit_type.value
+    doc_key = f"{user_id}_{limit_type_value}_{window_start_ts}"
     
-    @firestore.transactional
-    def update_in_transaction(transaction):
-        snapshot = doc_ref.get(transaction=transaction)
-        
-        if snapshot.exists:
-            current_count = snapshot.get("count") or 0
-        else:
-            current_count = 0
-        
-        # Check if within limit
-        allowed = current_count < config.limit
-        
-        # Increment if allowed and requested
-        if allowed and increment:
-            new_count = current_count + 1
-            transaction.set(doc_ref, {
-                "userId": user_id,
-                "type": limit_type.value,
-                "count": new_count,
-                "windowStart": window_start,
-                "windowEnd": window_end,
-                "lastUpdated": now,
-            }, merge=True)
-            current_count = new_count
-        
-        remaining = max(0, config.limit - current_count)
-        
+    # A window seen full moments ago is still full; deny without a round trip
+    cached_count = _get_cached_count(doc_key)
+    if cached_count is not None and cached_count >= config.limit:
         return RateLimitResult(
-            allowed=allowed,
-            current_count=current_count,
+            allowed=False,
+            current_count=cached_count,
             limit=config.limit,
-            remaining=remaining,
+            remaining=0,
             reset_at=window_end,
             window_seconds=config.window_seconds
         )
     
-    transaction = db.transaction()
-    return update_in_transaction(transaction)
-
-
-def check_image_upload_limit(user_id: str) -> RateLimitResult:
-    """
-    Check if user can upload an image.
+    # Single round trip when a Redis backend is configured
+    if get_redis_client() is not None:
+        try:
+            current_count, allowed = check_window_counter(
+                f"rl:{doc_key}",
+                config.limit,
+                window_start_ts + config.window_seconds,
+                increment
+            )
+            _remember_count(doc_key, current_count)
+            return RateLimitResult(
+                allowed=allowed,
+                current_count=current_count,
+                limit=config.limit,
+                remaining=max(0, config.limit - current_count),
+                reset_at=window_end,
+                window_seconds=config.window_seconds
+            )
+        except RedisError as e:
+            # Fall back to Firestore rather than failing the request
+            print(f"Redis rate limit check failed, using Firestore: {e}")
     
-    Args:
-        user_id: User ID
+    db = get_firestore_client()
+    doc_ref = db.collection("rate_limits").document(doc_key)
+    data = {
+        "userId": user_id,
+        "type": limit_type_value,
+        "count": firestore.Increment(1),
+        "windowStart": window_start,
+        "windowEnd": window_end,
+        "lastUpdated": now,
+    }
+    
+    if config.shards > 1:
+        # Shards are written blindly, so requests racing on the same
+        # window may overshoot the limit (see _check_sharded_counter)
+        current_count, allowed = _check_sharded_counter(
+            db, doc_key, config, data if increment else None
+        )
+    elif not increment:
+        snapshot = doc_ref.get()
+        current_count = (snapshot.get("count") or 0) if snapshot.exists else 0
+        allowed = current_count < config.limit
+    else:
+        # Optimistic concurrency: read, compare, then write only if the
+        # document is unchanged since the read. A lost race retries in the
+        # client instead of holding a server-side transaction lock.
+        allowed = False
+        current_count = 0
         
-    Returns:
-        RateLimitResult
-    """
-    return check_rate_limit(user_id, RateLimitType.IMAGE_UPLOAD)
+        for _ in range(RATE_LIMIT_WRITE_ATTEMPTS):
+            snapshot = doc_ref.get()
+            current_count = (snapshot.get("count") or 0) if snapshot.exists else 0
+            if current_count >= config.limit:
+                break
+            
+            try:
+                if snapshot.exists:
+                    doc_ref.update(
+                        data,
+                        option=db.write_option(last_update_time=snapshot.update_time)
+                    )
+                else:
+                    doc_ref.create(data)
+            except (FailedPrecondition, AlreadyExists):
+                continue
+            
+            allowed = True
+            current_count += 1
+            break
+        else:
+            # Lost every race: settle it in a transaction rather than
+            # denying a user who may be under their limit
+            current_count, allowed = _increment_in_transaction(
+                db, doc_ref, data, config.limit
+            )
+    
+    result = RateLimitResult(
+        allowed=allowed,
+        current_count=current_count,
+        limit=config.limit,
+        remaining=max(0, config.limit - current_count),
+        reset_at=window_end,
+        window_seconds=config.window_seconds
+    )
+    _remember_count(doc_key, result.current_count)
+    return result
 
 
-def check_text_message_limit(user_id: str) -> RateLimitResult:
+def check_rate_limit_sliding(
+    user_id: str,
+    limit_type: RateLimitType,
+    increment: bool = True
+) -> RateLimitResult:
     """
-    Check if user can send a text message.
+    Check if a user is within rate limits using a sliding window.
+    
+    Unlike check_rate_limit, this does not allow up to twice the limit
+    across a window boundary: the previous window's count is weighted by
+    how much of it still falls inside the sliding window. Requires the
+    Redis backend; falls back to the fixed window when it is unavailable.
     
     Args:
-        user_id: User ID
+        user_id: User ID to check
+        limit_type: Type of action being rate limited
+        increment: Whether to increment the counter (default True)
         
     Returns:
-        RateLimitResult
+        RateLimitResult with decision and details
     """
-    return check_rate_limit(user_id, RateLimitType.TEXT_MESSAGE)
+    if get_redis_client() is None:
+        return check_rate_limit(user_id, limit_type, increment)
+    
+    config = get_rate_limit_config(limit_type)
+    
+    now_ts = get_timestamp().timestamp()
+    window_start_ts = int(now_ts / config.window_seconds) * config.window_seconds
+    window_end_ts = window_start_ts + config.window_seconds
+    previous_weight = 1.0 - (now_ts - window_start_ts) / config.window_seconds
+    
+    key_prefix = f"rl:{user_id}_{limit_type.value}"
+    try:
+        current_count, allowed = check_sliding_counter(
+            f"{key_prefix}_{window_start_ts}",
+            f"{key_prefix}_{window_start_ts - config.window_seconds}",
+            config.limit,
+            previous_weight,
+            # Keep the counter alive while it is the previous window
+            window_end_ts + config.window_seconds,
+            increment
+        )
+    except RedisError as e:
+        print(f"Redis sliding rate limit check failed, using fixed window: {e}")
+        return check_rate_limit(user_id, limit_type, increment)
+    
+    return RateLimitResult(
+        allowed=allowed,
+        current_count=current_count,
+        limit=config.limit,
+        remaining=max(0, config.limit - current_count),
+        reset_at=datetime.fromtimestamp(window_end_ts, tz=timezone.utc),
+        window_seconds=config.window_seconds
+    )
 
 
-def check_report_limit(user_id: str) -> RateLimitResult:
-    """
-    Check if user can submit a report.
-    
-    Args:
-        user_id: User ID
-        
-    Returns:
-        RateLimitResult
-    """
-    return check_rate_limit(user_id, RateLimitType.REPORT)
+# Per-action checks, e.g. check_image_upload_limit(user_id). Bound with
+# partial rather than wrapper functions to skip a Python frame per request.
+check_image_upload_limit = functools.partial(
+    check_rate_limit, limit_type=RateLimitType.IMAGE_UPLOAD
+)
+check_text_message_limit = functools.partial(
+    check_rate_limit, limit_type=RateLimitType.TEXT_MESSAGE
+)
+check_report_limit = functools.partial(
+    check_rate_limit, limit_type=RateLimitType.REPORT
+)
 
 
 def get_user_rate_limit_status(user_id: str) -> dict:
@@ -220,15 +485,55 @@ def get_user_rate_limit_status(user_id: str) -> dict:
     """
     status = {}
     
+    if get_redis_client() is not None:
+        # Counters live in Redis; each read is a single round trip
+        for limit_type in RateLimitType:
+            # Check without incrementing
+            result = check_rate_limit(user_id, limit_type, increment=False)
+            status[limit_type.value] = {
+                "current": result.current_count,
+                "limit": result.limit,
+                "remaining": result.remaining,
+                "resetAt": result.reset_at.isoformat(),
+                "windowSeconds": result.window_seconds,
+            }
+        return status
+    
+    # Read-only, so fetch all window documents in one batched get
+    # instead of a transaction per limit type
+    db = get_firestore_client()
+    now = get_timestamp()
+    windows = {}
     for limit_type in RateLimitType:
-        # Check without incrementing
-        result = check_rate_limit(user_id, limit_type, increment=False)
+        config = get_rate_limit_config(limit_type)
+        window_start_ts = int(now.timestamp() / config.window_seconds) * config.window_seconds
+        doc_key = f"{user_id}_{limit_type.value}_{window_start_ts}"
+        windows[doc_key] = (limit_type, config, window_start_ts)
+    
+    # Map each counter document (or shard) back to its window
+    counter_keys = {
+        key: doc_key
+        for doc_key, (_, config, _) in windows.items()
+        for key in _shard_keys(doc_key, config.shards)
+    }
+    refs = [db.collection("rate_limits").document(key) for key in counter_keys]
+    counts = {}
+    for snapshot in db.get_all(refs):
+        if snapshot.exists:
+            doc_key = counter_keys[snapshot.id]
+            counts[doc_key] = counts.get(doc_key, 0) + (snapshot.get("count") or 0)
+    
+    for doc_key, (limit_type, config, window_start_ts) in windows.items():
+        current_count = counts.get(doc_key, 0)
+        reset_at = datetime.fromtimestamp(
+            window_start_ts + config.window_seconds, tz=timezone.utc
+        )
         status[limit_type.value] = {
-            "current": result.current_count,
-            "limit": result.limit,
-            "remaining": result.remaining,
-            "resetAt": result.reset_at.isoformat(),
-            "windowSeconds": result.window_seconds,
+            "current": current_count,
+            "limit": config.limit,
+            "remaining": max(0, config.limit - current_count),
+            "resetAt": reset_at.isoformat(),
+            "windowSeconds": config.window_seconds,
         }
     
     return status
@@ -251,27 +556,22 @@ def cleanup_expired_rate_limits(days_old: int = 1) -> int:
     
     cutoff = get_timestamp() - timedelta(days=days_old)
     
-    # Query for old documents
-    query = db.collection("rate_limits").where("windowEnd", "<", cutoff)
-    docs = query.stream()
+    # Query for old documents, projecting only the document name so no
+    # field data is downloaded
+    query = (
+        db.collection("rate_limits")
+        .where("windowEnd", "<", cutoff)
+        .select(["__name__"])
+    )
     
+    # BulkWriter pipelines the deletes with its own batching and flow control
     deleted = 0
-    batch = db.batch()
-    batch_size = 0
+    bulk_writer = db.bulk_writer()
     
-    for doc in docs:
-        batch.delete(doc.reference)
-        batch_size += 1
+    for doc in query.stream():
+        bulk_writer.delete(doc.reference)
         deleted += 1
-        
-        # Commit in batches of 500
-        if batch_size >= 500:
-            batch.commit()
-            batch = db.batch()
-            batch_size = 0
-    
-    # Commit remaining
-    if batch_size > 0:
-        batch.commit()
+    
+    bulk_writer.close()
     
     return deleted
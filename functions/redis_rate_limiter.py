@@ -0,0 +1,188 @@
+"""
+Redis backend for rate limiting.
+
+This module keeps the per-user, per-window counters in Redis (e.g.
+Memorystore) so a rate limit check costs a single round trip instead of
+a Firestore transaction. It is enabled by setting REDIS_HOST; without it
+rate limiting stays on Firestore.
+"""
+
+import functools
+import threading
+from typing import Optional
+
+try:
+    import redis
+except ImportError:  # Only needed when REDIS_HOST is set
+    redis = None
+
+from utils import get_env_var, get_env_int
+
+
+if redis is not None:
+    RedisError = redis.RedisError
+else:
+    class RedisError(Exception):
+        """Stand-in so callers can catch Redis errors without redis installed."""
+
+
+# Atomically read the window counter and increment it if under the limit.
+# KEYS[1] = counter key
+# ARGV[1] = limit, ARGV[2] = 1 to increment, ARGV[3] = window end (unix ts)
+# Returns {count, allowed}
+_CHECK_WINDOW_SCRIPT = """
+local count = tonumber(redis.call('GET', KEYS[1]) or '0')
+local limit = tonumber(ARGV[1])
+if count >= limit then
+    return {count, 0}
+end
+if ARGV[2] == '1' then
+    count = redis.call('INCR', KEYS[1])
+    if count == 1 then
+        redis.call('EXPIREAT', KEYS[1], ARGV[3])
+    end
+end
+return {count, 1}
+"""
+
+# Approximate sliding window: weight the previous window's count by how
+# much of it still overlaps the sliding window, then add the current count.
+# KEYS[1] = current window key, KEYS[2] = previous window key
+# ARGV[1] = limit, ARGV[2] = 1 to increment, ARGV[3] = previous window weight,
+# ARGV[4] = expiry (unix ts) for the current key
+# Returns {effective count, allowed}
+_CHECK_SLIDING_SCRIPT = """
+local curr = tonumber(redis.call('GET', KEYS[1]) or '0')
+local prev = tonumber(redis.call('GET', KEYS[2]) or '0')
+local limit = tonumber(ARGV[1])
+local effective = math.floor(prev * tonumber(ARGV[3])) + curr
+if effective >= limit then
+    return {effective, 0}
+end
+if ARGV[2] == '1' then
+    curr = redis.call('INCR', KEYS[1])
+    if curr == 1 then
+        redis.call('EXPIREAT', KEYS[1], ARGV[4])
+    end
+    effective = effective + 1
+end
+return {effective, 1}
+"""
+
+
+# Global Redis client and scripts (lazy loaded, reused across warm
+# invocations). The client is published last, under the lock, so a caller
+# that sees it also sees the scripts.
+_redis_client: Optional["redis.Redis"] = None
+_check_window_script = None
+_check_sliding_script = None
+_redis_lock = threading.Lock()
+
+
+@functools.cache
+def _warn_redis_missing() -> None:
+    """Log once that REDIS_HOST is ignored because redis is missing."""
+    print("REDIS_HOST is set but redis is not installed, using Firestore")
+
+
+def get_redis_client() -> Optional["redis.Redis"]:
+    """
+    Get or create the global Redis client.
+    
+    Returns:
+        Redis client, or None if REDIS_HOST is not configured or the
+        redis package is not installed
+    """
+    global _redis_client, _check_window_script, _check_sliding_script
+    if _redis_client is None:
+        host = get_env_var("REDIS_HOST")
+        if not host:
+            return None
+        if redis is None:
+            _warn_redis_missing()
+            return None
+        
+        with _redis_lock:
+            if _redis_client is None:
+                client = redis.Redis(
+                    connection_pool=redis.ConnectionPool(
+                        host=host,
+                        port=get_env_int("REDIS_PORT", 6379),
+                        socket_timeout=1.0,
+                        socket_connect_timeout=1.0,
+                    )
+                )
+                _check_window_script = client.register_script(_CHECK_WINDOW_SCRIPT)
+                _check_sliding_script = client.register_script(_CHECK_SLIDING_SCRIPT)
+                _redis_client = client
+    return _redis_client
+
+
+def check_window_counter(
+    key: str,
+    limit: int,
+    window_end_ts: int,
+    increment: bool = True
+) -> tuple[int, bool]:
+    """
+    Check and optionally increment a fixed-window counter.
+    
+    The counter expires at the end of its window, so no cleanup job is
+    needed for Redis-backed limits.
+    
+    Args:
+        key: Counter key for this user/type/window
+        limit: Maximum count allowed in the window
+        window_end_ts: Unix timestamp at which the window ends
+        increment: Whether to increment the counter if allowed
+    
+    Returns:
+        Tuple of (current count, allowed)
+    
+    Raises:
+        redis.RedisError: If Redis is unreachable or the script fails
+    """
+    get_redis_client()
+    count, allowed = _check_window_script(
+        keys=[key],
+        args=[limit, 1 if increment else 0, window_end_ts]
+    )
+    return int(count), bool(allowed)
+
+
+def check_sliding_counter(
+    current_key: str,
+    previous_key: str,
+    limit: int,
+    previous_weight: float,
+    expire_at_ts: int,
+    increment: bool = True
+) -> tuple[int, bool]:
+    """
+    Check and optionally increment an approximate sliding-window counter.
+    
+    Only two counters are kept per user and type, so memory stays O(1)
+    regardless of the limit.
+    
+    Args:
+        current_key: Counter key for the current fixed window
+        previous_key: Counter key for the previous fixed window
+        limit: Maximum count allowed in the sliding window
+        previous_weight: Fraction of the previous window still inside the
+            sliding window (0.0 to 1.0)
+        expire_at_ts: Unix timestamp at which the current counter can be
+            dropped (end of the following window)
+        increment: Whether to increment the counter if allowed
+    
+    Returns:
+        Tuple of (effective count, allowed)
+    
+    Raises:
+        redis.RedisError: If Redis is unreachable or the script fails
+    """
+    get_redis_client()
+    count, allowed = _check_sliding_script(
+        keys=[current_key, previous_key],
+        args=[limit, 1 if increment else 0, repr(previous_weight), expire_at_ts]
+    )
+    return int(count), bool(allowed)
@@ -6,8 +6,9 @@ allowing users to report messages/images with predefined categories
 and optional descriptions.
 """
 
-from typing import Optional
+from typing import Iterator, Optional
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 
 from utils import (
     get_firestore_client,
@@ -18,7 +19,11 @@ from utils import (
 from rate_limiter import check_report_limit
 
 
-@dataclass
+# Valid category values, built once for O(1) membership checks
+_VALID_CATEGORIES = frozenset(c.value for c in ReportCategory)
+
+
+@dataclass(frozen=True, slots=True)
 class ReportResult:
     """Result of submitting a report."""
     success: bool
@@ -36,8 +41,7 @@ def validate_report_category(category: str) -> bool:
     Returns:
         True if valid
     """
-    valid_categories = [c.value for c in ReportCategory]
-    return category.lower() in valid_categories
+    return category.lower() in _VALID_CATEGORIES
 
 
 def submit_report(
@@ -66,22 +70,22 @@ def submit_report(
             error=f"Invalid category: {category}. Must be one of: spam, harassment, inappropriate, other"
         )
     
-    # Check rate limit
-    rate_limit = check_report_limit(reporter_id)
-    if not rate_limit.allowed:
+    # Validate description length
+    if description and len(description) > 1000:
         return ReportResult(
             success=False,
             report_id=None,
-            error=f"Rate limit exceeded. You can submit {rate_limit.limit} reports per hour. "
-                  f"Try again at {rate_limit.reset_at.isoformat()}"
+            error="Description too long. Maximum 1000 characters."
         )
     
-    # Validate description length
-    if description and len(description) > 1000:
+    # Check rate limit (after validation so rejected reports don't consume it)
+    rate_limit = check_report_limit(reporter_id)
+    if not rate_limit.allowed:
         return ReportResult(
             success=False,
             report_id=None,
-            error="Description too long. Maximum 1000 characters."
+            error=f"Rate limit exceeded. You can submit {rate_limit.limit} reports per hour. "
+                  f"Try again at {rate_limit.reset_at.isoformat()}"
         )
     
     # Create report document
@@ -109,15 +113,41 @@ def submit_report(
     )
 
 
-def get_pending_reports(limit: int = 50) -> list[dict]:
+def _stream_reports(query) -> Iterator[dict]:
     """
-    Get pending reports for admin review.
+    Stream report documents from a query as dicts.
+    
+    Args:
+        query: Firestore query over the reports collection
+        
+    Yields:
+        Report data with its document ID under "id"
+    """
+    for doc in query.stream():
+        report = doc.to_dict()
+        report["id"] = doc.id
+        yield report
+
+
+def iter_pending_reports(limit: int = 50, start_after: Optional[str] = None) -> Iterator[dict]:
+    """
+    Iterate pending reports for admin review, oldest first.
+    
+    Reports are yielded as they arrive, so callers can start work on the
+    first one before the whole page has been read. The cursor is checked
+    when this is called, not when iteration starts.
     
     Args:
         limit: Maximum number of reports to return
+        start_after: ID of the last report from the previous page, to
+            continue after it
         
     Returns:
-        List of pending report documents
+        Iterator over pending report documents
+        
+    Raises:
+        ValueError: If the start_after report no longer exists, since
+            paging can't resume from it (restart from the first page)
     """
     db = get_firestore_client()
     
@@ -125,18 +155,36 @@ def get_pending_reports(limit: int = 50) -> list[dict]:
         db.collection("reports")
         .where("status", "==", ReportStatus.PENDING.value)
         .order_by("timestamp")
-        .limit(limit)
     )
     
-    docs = query.stream()
+    if start_after:
+        cursor = db.collection("reports").document(start_after).get()
+        if not cursor.exists:
+            # Dropping the cursor would silently serve the first page again
+            raise ValueError(f"Unknown report cursor: {start_after}")
+        query = query.start_after(cursor)
     
-    reports = []
-    for doc in docs:
-        report = doc.to_dict()
-        report["id"] = doc.id
-        reports.append(report)
+    query = query.limit(limit)
     
-    return reports
+    return _stream_reports(query)
+
+
+def get_pending_reports(limit: int = 50, start_after: Optional[str] = None) -> list[dict]:
+    """
+    Get pending reports for admin review, oldest first.
+    
+    Args:
+        limit: Maximum number of reports to return
+        start_after: ID of the last report from the previous page, to
+            continue after it
+        
+    Returns:
+        List of pending report documents
+        
+    Raises:
+        ValueError: If the start_after report no longer exists
+    """
+    return list(iter_pending_reports(limit, start_after))
 
 
 def get_reports_by_message(message_id: str) -> list[dict]:
@@ -157,15 +205,7 @@ def get_reports_by_message(message_id: str) -> list[dict]:
         .order_by("timestamp", direction="DESCENDING")
     )
     
-    docs = query.stream()
-    
-    reports = []
-    for doc in docs:
-        report = doc.to_dict()
-        report["id"] = doc.id
-        reports.append(report)
-    
-    return reports
+    return list(_stream_reports(query))
 
 
 def get_reports_by_user(reporter_id: str, limit: int = 20) -> list[dict]:
@@ -188,15 +228,7 @@ def get_reports_by_user(reporter_id: str, limit: int = 20) -> list[dict]:
         .limit(limit)
     )
     
-    docs = query.stream()
-    
-    reports = []
-    for doc in docs:
-        report = doc.to_dict()
-        report["id"] = doc.id
-        reports.append(report)
-    
-    return reports
+    return list(_stream_reports(query))
 
 
 def mark_report_reviewed(report_id: str, reviewer_notes: Optional[str] = None) -> bool:
@@ -229,31 +261,53 @@ def mark_report_reviewed(report_id: str, reviewer_notes: Optional[str] = None) -
         return False
 
 
+def _count_query(query) -> int:
+    """
+    Count documents matching a query using a server-side aggregation.
+    
+    Args:
+        query: Firestore query to count
+    
+    Returns:
+        Number of matching documents
+    """
+    return int(query.count().get()[0][0].value)
+
+
 def get_report_stats() -> dict:
     """
     Get report statistics for monitoring.
     
+    Each count is a server-side aggregation, and the queries are issued
+    concurrently since they are independent.
+    
     Returns:
         Dictionary with report statistics
     """
     db = get_firestore_client()
     
-    # Count pending reports
     pending_query = (
         db.collection("reports")
         .where("status", "==", ReportStatus.PENDING.value)
     )
-    pending_count = len(list(pending_query.stream()))
     
     # Count by category (for pending only)
-    stats_by_category = {}
-    for category in ReportCategory:
-        cat_query = (
-            db.collection("reports")
-            .where("status", "==", ReportStatus.PENDING.value)
-            .where("category", "==", category.value)
-        )
-        stats_by_category[category.value] = len(list(cat_query.stream()))
+    category_queries = {
+        category.value: pending_query.where("category", "==", category.value)
+        for category in ReportCategory
+    }
+    
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        pending_future = executor.submit(_count_query, pending_query)
+        category_futures = {
+            category: executor.submit(_count_query, query)
+            for category, query in category_queries.items()
+        }
+        pending_count = pending_future.result()
+        stats_by_category = {
+            category: future.result()
+            for category, future in category_futures.items()
+        }
     
     return {
         "pendingCount": pending_count,
@@ -0,0 +1,69 @@
+"""
+Shared pytest fixtures.
+"""
+
+import sys
+from pathlib import Path
+
+# Add parent directory to path for imports (loaded once, before any test module)
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import pytest
+from io import BytesIO
+
+from PIL import Image
+
+from tests.fake_firestore import FakeFirestore
+
+
+# Pre-encoded 100x100 solid-blue RGB PNG, so no zlib encode runs for it
+_PNG_100_RGB = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000064000000640802000000ff8002"
+    "030000009f4944415478daedd0310100000803a069ffce5ac1cf072250c9849b"
+    "56204b962c59b2642990254b962c59b214c892254b962c590a64c992254b962c"
+    "05b264c992254b960259b264c992254b812c59b264c992a540962c59b264c952"
+    "204b962c59b2642990254b962c59b214c892254b962c590a64c992254b962c05"
+    "b264c992254b960259b264c992254b812c59b264c992a540962c59b264c95220"
+    "4bd6b705886001c7c3e942250000000049454e44ae426082"
+)
+
+
+def _decoded(mode: str, size: tuple[int, int], format: str) -> Image.Image:
+    """Encode a solid-colour image and open it again, as uploads are."""
+    output = BytesIO()
+    Image.new(mode, size, color='blue').save(output, format=format)
+    output.seek(0)
+    return Image.open(output)
+
+
+# Session-scoped images are shared between tests; only use them in tests
+# that don't modify the image (e.g. draft(), thumbnail(), convert in place).
+
+@pytest.fixture(scope="session")
+def jpeg_image() -> Image.Image:
+    """Decoded 100x100 RGB JPEG."""
+    return _decoded('RGB', (100, 100), 'JPEG')
+
+
+@pytest.fixture(scope="session")
+def png_image() -> Image.Image:
+    """Decoded 100x100 RGB PNG."""
+    return Image.open(BytesIO(_PNG_100_RGB))
+
+
+@pytest.fixture(scope="session")
+def rgba_transparent_image() -> Image.Image:
+    """100x100 RGBA image with partial transparency."""
+    return Image.new('RGBA', (100, 100), color=(255, 0, 0, 128))
+
+
+@pytest.fixture(scope="session")
+def rgba_opaque_image() -> Image.Image:
+    """100x100 RGBA image that's fully opaque."""
+    return Image.new('RGBA', (100, 100), color=(255, 0, 0, 255))
+
+
+@pytest.fixture
+def fake_firestore() -> FakeFirestore:
+    """Empty in-memory Firestore client."""
+    return FakeFirestore()
@@ -0,0 +1,123 @@
+"""
+Minimal in-memory stand-in for the Firestore client.
+
+Plain classes instead of MagicMock trees, covering only the calls the
+modules under test make: collection().add(), document() get, create,
+set (with merge) and update, including Increment transforms, and batches
+of set() calls. create() and update(option=write_option(last_update_time=))
+fail like Firestore does when another writer got there first.
+"""
+
+from itertools import count
+
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+from google.cloud.firestore_v1.transforms import Increment
+
+
+class FakeSnapshot:
+    """Snapshot of a fake document."""
+    
+    def __init__(self, doc_id: str, data: dict | None, update_time: int):
+        self.id = doc_id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = data or {}
+    
+    def get(self, field: str):
+        return self._data.get(field)
+    
+    def to_dict(self) -> dict | None:
+        return dict(self._data) if self.exists else None
+
+
+class FakeDocument:
+    """Reference to a document in a fake collection."""
+    
+    def __init__(self, collection: "FakeCollection", doc_id: str):
+        self._collection = collection
+        self.id = doc_id
+    
+    def get(self) -> FakeSnapshot:
+        data = self._collection.docs.get(self.id)
+        return FakeSnapshot(self.id, data, self._collection.update_times.get(self.id, 0))
+    
+    def create(self, data: dict) -> None:
+        if self.id in self._collection.docs:
+            raise AlreadyExists(f"{self.id} already exists")
+        self._write({}, data)
+    
+    def set(self, data: dict, merge: bool = False) -> None:
+        existing = self._collection.docs.get(self.id, {}) if merge else {}
+        self._write(dict(existing), data)
+    
+    def update(self, data: dict, option=None) -> None:
+        if self.id not in self._collection.docs:
+            raise NotFound(f"{self.id} not found")
+        expected = (option or {}).get("last_update_time")
+        if expected is not None and expected != self._collection.update_times[self.id]:
+            raise FailedPrecondition(f"{self.id} changed since it was read")
+        self._write(dict(self._collection.docs[self.id]), data)
+    
+    def _write(self, base: dict, data: dict) -> None:
+        for field, value in data.items():
+            if isinstance(value, Increment):
+                value = (base.get(field) or 0) + value.value
+            base[field] = value
+        self._collection.docs[self.id] = base
+        self._collection.update_times[self.id] = next(self._collection.clock)
+
+
+class FakeCollection:
+    """A fake collection holding documents in a dict."""
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.docs: dict[str, dict] = {}
+        self.update_times: dict[str, int] = {}
+        self.clock = count(1)
+        self._ids = count(1)
+    
+    def document(self, doc_id: str | None = None) -> FakeDocument:
+        if doc_id is None:
+            doc_id = f"{self.name}{next(self._ids)}"
+        return FakeDocument(self, doc_id)
+    
+    def add(self, data: dict) -> tuple[None, FakeDocument]:
+        doc = self.document()
+        doc.set(data)
+        return None, doc
+
+
+class FakeBatch:
+    """A write batch applied on commit()."""
+    
+    def __init__(self, db: "FakeFirestore"):
+        self._db = db
+        self._writes = []
+    
+    def set(self, doc: FakeDocument, data: dict, merge: bool = False) -> None:
+        self._writes.append((doc, data, merge))
+    
+    def commit(self) -> None:
+        self._db.commits += 1
+        for doc, data, merge in self._writes:
+            doc.set(data, merge=merge)
+
+
+class FakeFirestore:
+    """A fake Firestore client with in-memory collections."""
+    
+    def __init__(self):
+        self.collections: dict[str, FakeCollection] = {}
+        self.commits = 0
+    
+    def collection(self, name: str) -> FakeCollection:
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(name)
+        return self.collections[name]
+    
+    def write_option(self, **kwargs) -> dict:
+        return kwargs
+    
+    def batch(self) -> FakeBatch:
+        return FakeBatch(self)
@@ -5,12 +5,6 @@ Unit tests for image moderation module.
 import pytest
 from unittest.mock import patch, MagicMock
 
-import sys
-from pathlib import Path
-
-# Add parent directory to path for imports
-sys.path.insert(0, str(Path(__file__).parent.parent))
-
 from image_moderation import (
     SafeSearchLikelihood,
     ModerationResult,
@@ -30,159 +24,119 @@ class TestSafeSearchLikelihood:
         assert SafeSearchLikelihood.UNLIKELY.value < SafeSearchLikelihood.POSSIBLE.value
         assert SafeSearchLikelihood.POSSIBLE.value < SafeSearchLikelihood.LIKELY.value
         assert SafeSearchLikelihood.LIKELY.value < SafeSearchLikelihood.VERY_LIKELY.value
-
-
-class TestEvaluateSafeSearchScores:
-    """Tests for evaluating SafeSearch scores."""
     
-    def test_clean_image_approved(self):
-        """Image with all low scores should be approved."""
-        scores = {
-            "adult": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "violence": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "racy": {"likelihood": 2, "name": "UNLIKELY"},
-            "medical": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "spoof": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-        }
+    def test_annotation_to_scores(self):
+        """SafeSearch annotations should convert to value/name pairs."""
+        from google.cloud import vision
+        from image_moderation import _safesearch_to_scores
         
-        result = evaluate_safesearch_scores(scores)
+        annotation = vision.SafeSearchAnnotation(adult=5, violence=1, racy=3)
         
-        assert result.allowed is True
-        assert result.action == ModerationAction.APPROVED
-        assert result.categories_flagged == []
-    
-    def test_adult_content_blocked(self):
-        """Image with high adult score should be blocked."""
-        scores = {
-            "adult": {"likelihood": 4, "name": "LIKELY"},
-            "violence": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "racy": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "medical": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "spoof": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-        }
-        
-        result = evaluate_safesearch_scores(scores)
+        scores = _safesearch_to_scores(annotation)
         
-        assert result.allowed is False
-        assert result.action == ModerationAction.BLOCKED
-        assert "adult" in result.categories_flagged
+        assert set(scores) == {"adult", "violence", "racy", "medical", "spoof"}
+        assert scores["adult"] == {"likelihood": 5, "name": "VERY_LIKELY"}
+        assert scores["racy"]["name"] == "POSSIBLE"
+        assert scores["spoof"]["name"] == "UNKNOWN"
     
-    def test_violence_blocked(self):
-        """Image with high violence score should be blocked."""
-        scores = {
-            "adult": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "violence": {"likelihood": 5, "name": "VERY_LIKELY"},
-            "racy": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "medical": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "spoof": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-        }
+    @patch('image_moderation.get_vision_client')
+    def test_api_error_not_retried_again(self, mock_get_client):
+        """Errors surviving the Retry policy should not be retried by hand."""
+        from google.api_core.exceptions import ServiceUnavailable
+        from image_moderation import analyze_image_safesearch, VISION_RETRY
         
-        result = evaluate_safesearch_scores(scores)
+        client = mock_get_client.return_value
+        client.safe_search_detection.side_effect = ServiceUnavailable("down")
         
-        assert result.allowed is False
-        assert "violence" in result.categories_flagged
-    
-    def test_racy_blocked(self):
-        """Image with high racy score should be blocked."""
-        scores = {
-            "adult": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "violence": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "racy": {"likelihood": 4, "name": "LIKELY"},
-            "medical": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "spoof": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-        }
-        
-        result = evaluate_safesearch_scores(scores)
+        scores, error = analyze_image_safesearch(b"fake image bytes")
         
-        assert result.allowed is False
-        assert "racy" in result.categories_flagged
+        assert scores == {}
+        assert "Vision API failed" in error
+        client.safe_search_detection.assert_called_once()
+        assert client.safe_search_detection.call_args[1]["retry"] is VISION_RETRY
+
+
+def _score(likelihood: int) -> dict:
+    """Build a single SafeSearch category score."""
+    return {"likelihood": likelihood, "name": SafeSearchLikelihood(likelihood).name}
+
+
+class TestEvaluateSafeSearchScores:
+    """Tests for evaluating SafeSearch scores."""
     
-    def test_medical_not_blocked(self):
-        """Medical content alone should not block."""
-        scores = {
-            "adult": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "violence": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "racy": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "medical": {"likelihood": 5, "name": "VERY_LIKELY"},
-            "spoof": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-        }
-        
-        result = evaluate_safesearch_scores(scores)
-        
-        # Medical is not in blocking categories
-        assert result.allowed is True
+    BASE_SCORES = {
+        "adult": _score(1),
+        "violence": _score(1),
+        "racy": _score(1),
+        "medical": _score(1),
+        "spoof": _score(1),
+    }
     
-    def test_spoof_not_blocked(self):
-        """Spoof content alone should not block."""
-        scores = {
-            "adult": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "violence": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "racy": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "medical": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "spoof": {"likelihood": 5, "name": "VERY_LIKELY"},
-        }
+    @pytest.mark.parametrize("overrides, threshold, expected_flagged", [
+        # Clean image is approved
+        ({"racy": _score(2)}, SafeSearchLikelihood.LIKELY, []),
+        # Each blocking category blocks on its own
+        ({"adult": _score(4)}, SafeSearchLikelihood.LIKELY, ["adult"]),
+        ({"violence": _score(5)}, SafeSearchLikelihood.LIKELY, ["violence"]),
+        ({"racy": _score(4)}, SafeSearchLikelihood.LIKELY, ["racy"]),
+        # Medical and spoof are not blocking categories
+        ({"medical": _score(5)}, SafeSearchLikelihood.LIKELY, []),
+        ({"spoof": _score(5)}, SafeSearchLikelihood.LIKELY, []),
+        # Multiple violations are all flagged
+        (
+            {"adult": _score(5), "violence": _score(4), "racy": _score(5)},
+            SafeSearchLikelihood.LIKELY,
+            ["adult", "violence", "racy"],
+        ),
+        # POSSIBLE does not block with the default LIKELY threshold
+        (
+            {"adult": _score(3), "violence": _score(3), "racy": _score(3)},
+            SafeSearchLikelihood.LIKELY,
+            [],
+        ),
+        # A POSSIBLE threshold blocks POSSIBLE content
+        ({"adult": _score(3)}, SafeSearchLikelihood.POSSIBLE, ["adult"]),
+    ])
+    def test_evaluate(self, overrides, threshold, expected_flagged):
+        """Scores should be approved or blocked with the expected categories."""
+        scores = {**self.BASE_SCORES, **overrides}
         
-        result = evaluate_safesearch_scores(scores)
+        result = evaluate_safesearch_scores(scores, threshold=threshold)
         
-        assert result.allowed is True
+        assert result.allowed is (not expected_flagged)
+        expected_action = ModerationAction.BLOCKED if expected_flagged else ModerationAction.APPROVED
+        assert result.action == expected_action
+        assert sorted(result.categories_flagged) == sorted(expected_flagged)
     
-    def test_multiple_violations(self):
-        """Multiple violations should all be flagged."""
-        scores = {
-            "adult": {"likelihood": 5, "name": "VERY_LIKELY"},
-            "violence": {"likelihood": 4, "name": "LIKELY"},
-            "racy": {"likelihood": 5, "name": "VERY_LIKELY"},
-            "medical": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "spoof": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-        }
-        
-        result = evaluate_safesearch_scores(scores)
+    def test_is_blocked_matches_evaluate(self):
+        """is_blocked should agree with evaluate_safesearch_scores."""
+        from image_moderation import is_blocked
         
-        assert result.allowed is False
-        assert len(result.categories_flagged) == 3
-        assert "adult" in result.categories_flagged
-        assert "violence" in result.categories_flagged
-        assert "racy" in result.categories_flagged
-    
-    def test_possible_not_blocked_by_default(self):
-        """POSSIBLE likelihood should not block with default LIKELY threshold."""
-        scores = {
-            "adult": {"likelihood": 3, "name": "POSSIBLE"},
-            "violence": {"likelihood": 3, "name": "POSSIBLE"},
+        clean = {
+            "adult": {"likelihood": 1, "name": "VERY_UNLIKELY"},
+            "violence": {"likelihood": 2, "name": "UNLIKELY"},
             "racy": {"likelihood": 3, "name": "POSSIBLE"},
-            "medical": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "spoof": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-        }
-        
-        result = evaluate_safesearch_scores(
-            scores, 
-            threshold=SafeSearchLikelihood.LIKELY
-        )
-        
-        assert result.allowed is True
-    
-    def test_custom_threshold_possible(self):
-        """Custom POSSIBLE threshold should block POSSIBLE content."""
-        scores = {
-            "adult": {"likelihood": 3, "name": "POSSIBLE"},
-            "violence": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "racy": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "medical": {"likelihood": 1, "name": "VERY_UNLIKELY"},
-            "spoof": {"likelihood": 1, "name": "VERY_UNLIKELY"},
+            "medical": {"likelihood": 5, "name": "VERY_LIKELY"},
         }
+        violent = dict(clean, violence={"likelihood": 4, "name": "LIKELY"})
         
-        result = evaluate_safesearch_scores(
-            scores, 
-            threshold=SafeSearchLikelihood.POSSIBLE
-        )
+        for scores in (clean, violent):
+            expected = not evaluate_safesearch_scores(scores, SafeSearchLikelihood.LIKELY).allowed
+            assert is_blocked(scores, SafeSearchLikelihood.LIKELY) is expected
         
-        assert result.allowed is False
-        assert "adult" in result.categories_flagged
+        assert is_blocked(clean, SafeSearchLikelihood.POSSIBLE) is True
 
 
 class TestModerateImage:
     """Tests for the full moderation pipeline."""
     
+    @pytest.fixture(autouse=True)
+    def no_cache(self):
+        """Keep the moderation cache out of pipeline tests."""
+        with patch('image_moderation.get_cached_scores', return_value=None), \
+             patch('image_moderation.cache_scores'):
+            yield
+    
     @patch('image_moderation.analyze_image_safesearch')
     @patch('image_moderation.log_moderation_event')
     def test_moderate_clean_image(self, mock_log, mock_analyze):
@@ -252,3 +206,284 @@ class TestModerateImage:
         
         assert result.allowed is False
         assert result.action == ModerationAction.QUEUED
+    
+    @patch('image_moderation.analyze_image_safesearch')
+    @patch('image_moderation.log_moderation_event')
+    def test_cache_hit_skips_vision(self, mock_log, mock_analyze):
+        """Cached scores for identical content should skip Vision."""
+        from image_moderation import moderate_image
+        
+        cached = {
+            "adult": {"likelihood": 5, "name": "VERY_LIKELY"},
+            "violence": {"likelihood": 1, "name": "VERY_UNLIKELY"},
+            "racy": {"likelihood": 1, "name": "VERY_UNLIKELY"},
+        }
+        
+        with patch('image_moderation.get_cached_scores', return_value=cached), \
+             patch('image_moderation.log_blocked_content'), \
+             patch('image_moderation.increment_user_violations') as mock_increment:
+            result = moderate_image(
+                image_content=b"fake image bytes",
+                user_id="user123",
+                image_path="pending/user123/image1.jpg",
+                image_id="image1"
+            )
+        
+        assert result.action == ModerationAction.BLOCKED
+        mock_analyze.assert_not_called()
+        mock_increment.assert_called_once_with("user123")
+    
+    @patch('image_moderation.analyze_image_safesearch')
+    @patch('image_moderation.log_moderation_event')
+    def test_cache_miss_stores_scores(self, mock_log, mock_analyze):
+        """Successful analyses should be cached, failures should not."""
+        from image_moderation import moderate_image, content_hash
+        
+        scores = {"adult": {"likelihood": 1, "name": "VERY_UNLIKELY"}}
+        
+        with patch('image_moderation.cache_scores') as mock_cache:
+            mock_analyze.return_value = (scores, None)
+            moderate_image(b"img", "user123", "pending/user123/a", "a")
+            mock_cache.assert_called_once_with(content_hash(b"img"), scores)
+            
+            mock_cache.reset_mock()
+            mock_analyze.return_value = ({}, "Vision API error")
+            moderate_image(b"img", "user123", "pending/user123/a", "a")
+            mock_cache.assert_not_called()
+
+
+class TestModerationCache:
+    """Tests for the content-hash moderation cache."""
+    
+    def test_content_hash_stable(self):
+        """Identical bytes should hash the same, different bytes should not."""
+        from image_moderation import content_hash
+        
+        assert content_hash(b"abc") == content_hash(b"abc")
+        assert content_hash(b"abc") != content_hash(b"abd")
+        assert len(content_hash(b"abc")) == 32
+    
+    @patch('image_moderation.get_firestore_client')
+    def test_expired_entry_is_miss(self, mock_firestore):
+        """Entries past expiresAt should be ignored."""
+        from datetime import datetime, timezone
+        from image_moderation import get_cached_scores
+        
+        snapshot = mock_firestore.return_value.collection.return_value.document.return_value.get.return_value
+        snapshot.exists = True
+        snapshot.to_dict.return_value = {
+            "scores": {"adult": {"likelihood": 1, "name": "VERY_UNLIKELY"}},
+            "expiresAt": datetime(2020, 1, 1, tzinfo=timezone.utc),
+        }
+        
+        assert get_cached_scores("somehash") is None
+    
+    @patch('image_moderation.get_firestore_client')
+    def test_lookup_error_is_miss(self, mock_firestore):
+        """Firestore errors should fall back to a cache miss."""
+        from image_moderation import get_cached_scores
+        
+        mock_firestore.side_effect = Exception("firestore unavailable")
+        
+        assert get_cached_scores("somehash") is None
+
+
+class TestBatchModeration:
+    """Tests for batched SafeSearch moderation."""
+    
+    @staticmethod
+    def _response(adult=1, error=""):
+        response = MagicMock()
+        response.error.message = error
+        annotation = response.safe_search_annotation
+        annotation.adult = adult
+        annotation.violence = 1
+        annotation.racy = 1
+        annotation.medical = 1
+        annotation.spoof = 1
+        return response
+    
+    @patch('image_moderation.get_vision_client')
+    def test_batch_chunks_requests(self, mock_get_client):
+        """Images should be sent in chunks of VISION_BATCH_SIZE."""
+        from image_moderation import analyze_images_safesearch_batch, VISION_BATCH_SIZE
+        
+        client = mock_get_client.return_value
+        client.batch_annotate_images.side_effect = lambda requests, retry: MagicMock(
+            responses=[self._response() for _ in requests]
+        )
+        
+        uris = [f"gs://bucket/queued/user/img{i}" for i in range(VISION_BATCH_SIZE + 4)]
+        results = analyze_images_safesearch_batch(uris)
+        
+        assert client.batch_annotate_images.call_count == 2
+        assert len(results) == len(uris)
+        assert all(error is None for _, error in results)
+    
+    @patch('image_moderation.get_vision_client')
+    def test_batch_per_image_error(self, mock_get_client):
+        """A per-image error should only affect that image."""
+        from image_moderation import analyze_images_safesearch_batch
+        
+        client = mock_get_client.return_value
+        client.batch_annotate_images.return_value = MagicMock(
+            responses=[self._response(adult=5), self._response(error="bad image")]
+        )
+        
+        results = analyze_images_safesearch_batch(["gs://b/a", "gs://b/c"])
+        
+        assert results[0][0]["adult"]["name"] == "VERY_LIKELY"
+        assert results[0][1] is None
+        assert results[1] == ({}, "Vision API error: bad image")
+    
+    @patch('image_moderation.get_vision_client')
+    def test_batch_short_response_fails_chunk(self, mock_get_client):
+        """Missing responses should fail the chunk, not shift scores between images."""
+        from image_moderation import analyze_images_safesearch_batch
+        
+        client = mock_get_client.return_value
+        client.batch_annotate_images.return_value = MagicMock(
+            responses=[self._response(adult=1)]
+        )
+        
+        results = analyze_images_safesearch_batch(["gs://b/a", "gs://b/c"])
+        
+        assert len(results) == 2
+        assert all(scores == {} and error for scores, error in results)
+    
+    @patch('image_moderation.analyze_images_safesearch_batch')
+    @patch('image_moderation.log_moderation_event')
+    def test_moderate_images_batch_keeps_order(self, mock_log, mock_analyze):
+        """Results should map back to the input images by position."""
+        from image_moderation import moderate_images_batch
+        
+        clean = {
+            "adult": {"likelihood": 1, "name": "VERY_UNLIKELY"},
+            "violence": {"likelihood": 1, "name": "VERY_UNLIKELY"},
+            "racy": {"likelihood": 1, "name": "VERY_UNLIKELY"},
+        }
+        mock_analyze.return_value = [(clean, None), ({}, "Vision API error")]
+        
+        results = moderate_images_batch(
+            [("u1", "queued/u1/a", "a"), ("u2", "queued/u2/b", "b")],
+            "bucket"
+        )
+        
+        mock_analyze.assert_called_once_with(["gs://bucket/queued/u1/a", "gs://bucket/queued/u2/b"])
+        assert results[0].action == ModerationAction.APPROVED
+        assert results[1].action == ModerationAction.QUEUED
+    
+    @patch('image_moderation.vision.ImageAnnotatorClient')
+    def test_vision_client_reused(self, mock_client_cls):
+        """The Vision client should be created once and reused."""
+        import image_moderation
+        
+        with patch.object(image_moderation, '_vision_client', None):
+            first = image_moderation.get_vision_client()
+            second = image_moderation.get_vision_client()
+        
+        assert first is second
+        mock_client_cls.assert_called_once()
+
+
+class TestMoveImage:
+    """Tests for moving images between folders."""
+    
+    @patch('image_moderation.get_storage_bucket')
+    def test_move_pins_source_generation(self, mock_bucket):
+        """Only the given generation of the pending image should be moved."""
+        from image_moderation import move_image_to_approved
+        
+        bucket = mock_bucket.return_value
+        
+        move_image_to_approved("pending/u1/a.jpg", "u1", "a.jpg", source_generation=42)
+        
+        bucket.blob.assert_called_once_with("pending/u1/a.jpg", generation=42)
+        bucket.copy_blob.assert_called_once_with(
+            bucket.blob.return_value, bucket, "approved/u1/a.jpg", source_generation=42
+        )
+        bucket.blob.return_value.delete.assert_called_once()
+
+
+class TestShrinkForModeration:
+    """Tests for downscaling images before Vision analysis."""
+    
+    @staticmethod
+    def _png(width, height):
+        from io import BytesIO
+        from PIL import Image
+        
+        output = BytesIO()
+        Image.new('RGB', (width, height), color='blue').save(output, format='PNG')
+        return output.getvalue()
+    
+    def test_large_image_downscaled(self):
+        """Images over the max dimension should be resized to fit."""
+        from io import BytesIO
+        from PIL import Image
+        from image_moderation import _shrink_for_moderation
+        
+        shrunk = _shrink_for_moderation(self._png(3000, 1500), max_dim=1024)
+        img = Image.open(BytesIO(shrunk))
+        
+        assert img.format == 'JPEG'
+        assert img.size == (1024, 512)
+    
+    def test_large_jpeg_decoded_at_reduced_scale(self):
+        """Large JPEGs should be decoded with shrink-on-load, not in full."""
+        from io import BytesIO
+        from PIL import Image
+        from image_moderation import _shrink_for_moderation
+        
+        output = BytesIO()
+        Image.new('RGB', (4000, 2000), color='blue').save(output, format='JPEG')
+        
+        decoded_sizes = []
+        thumbnail = Image.Image.thumbnail
+        
+        def record_size(img, *args, **kwargs):
+            decoded_sizes.append(img.size)
+            return thumbnail(img, *args, **kwargs)
+        
+        with patch.object(Image.Image, 'thumbnail', record_size):
+            shrunk = _shrink_for_moderation(output.getvalue(), max_dim=1024)
+        
+        assert decoded_sizes == [(2000, 1000)]
+        assert Image.open(BytesIO(shrunk)).size == (1024, 512)
+    
+    def test_small_image_unchanged(self):
+        """Images within the max dimension should be passed through."""
+        from image_moderation import _shrink_for_moderation
+        
+        image_bytes = self._png(800, 600)
+        
+        assert _shrink_for_moderation(image_bytes, max_dim=1024) is image_bytes
+    
+    def test_undecodable_bytes_unchanged(self):
+        """Bytes PIL cannot read should be left for Vision to handle."""
+        from image_moderation import _shrink_for_moderation
+        
+        assert _shrink_for_moderation(b"fake image bytes", max_dim=1024) == b"fake image bytes"
+    
+    @patch('image_moderation.cache_scores')
+    @patch('image_moderation.get_cached_scores', return_value=None)
+    @patch('image_moderation.analyze_image_safesearch', return_value=({}, "vision unavailable"))
+    @patch('image_moderation.log_moderation_event')
+    def test_upload_path_sends_shrunk_bytes(self, mock_log, mock_analyze, mock_get_cached, mock_cache):
+        """moderate_image should send Vision the downscaled upload bytes."""
+        from io import BytesIO
+        from PIL import Image
+        from image_moderation import moderate_image, content_hash
+        
+        image_bytes = self._png(3000, 1500)
+        
+        moderate_image(
+            image_content=image_bytes,
+            user_id="user123",
+            image_path="pending/user123/image1.png",
+            image_id="image1"
+        )
+        
+        sent = mock_analyze.call_args[0][0]
+        assert Image.open(BytesIO(sent)).size == (1024, 512)
+        mock_get_cached.assert_called_once_with(content_hash(image_bytes))
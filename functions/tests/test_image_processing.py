@@ -2,15 +2,10 @@
 Unit tests for image processing module.
 """
 
+import functools
 import pytest
 from io import BytesIO
 
-import sys
-from pathlib import Path
-
-# Add parent directory to path for imports
-sys.path.insert(0, str(Path(__file__).parent.parent))
-
 from PIL import Image
 
 from image_processing import (
@@ -20,114 +15,72 @@ from image_processing import (
     get_image_format,
     should_use_png,
     get_image_info,
+    draft_for_size,
     DEFAULT_THUMBNAIL_SIZE,
     DEFAULT_COMPRESSED_MAX_SIZE,
 )
 
 
+@functools.lru_cache(maxsize=None)
 def create_test_image(width: int, height: int, mode: str = 'RGB', format: str = 'JPEG') -> bytes:
-    """Create a test image of specified size."""
+    """Create a test image of specified size (cached; bytes are immutable)."""
     img = Image.new(mode, (width, height), color='blue')
     output = BytesIO()
-    if format == 'JPEG' and mode == 'RGBA':
-        img = img.convert('RGB')
-    img.save(output, format=format)
-    output.seek(0)
-    return output.read()
+    if format == 'JPEG':
+        if mode == 'RGBA':
+            img = img.convert('RGB')
+        # Cheapest encoder settings; tests don't care about file size
+        img.save(output, format=format, quality=75, optimize=False,
+                 progressive=False, subsampling=2)
+    else:
+        img.save(output, format=format)
+    return output.getvalue()
 
 
 class TestCompressImage:
     """Tests for image compression."""
     
-    def test_compress_small_image(self):
-        """Small images should not be resized."""
-        image_bytes = create_test_image(100, 100)
+    @pytest.mark.parametrize("width, height, max_dim, check", [
+        # Small images should not be resized
+        (100, 100, None, lambda size: size == (100, 100)),
+        # Large images should be resized to max dimension
+        (3000, 2000, (1920, 1920), lambda size: size[0] <= 1920 and size[1] <= 1920),
+        # Compression should maintain aspect ratio (2:1, approximately)
+        (4000, 2000, (1920, 1920), lambda size: 1.9 < size[0] / size[1] < 2.1),
+        # Image already smaller than max should not be upscaled
+        (500, 500, (1920, 1920), lambda size: size == (500, 500)),
+    ], ids=["small", "large", "aspect_ratio", "already_small"])
+    def test_compress(self, width, height, max_dim, check):
+        """Compressed size should fit the max dimension without upscaling."""
+        image_bytes = create_test_image(width, height)
+        kwargs = {} if max_dim is None else {"max_dimension": max_dim}
         
-        compressed, format_used, size = compress_image(image_bytes)
+        compressed, format_used, size = compress_image(image_bytes, **kwargs)
         
-        assert size == (100, 100)
+        assert check(size)
         assert format_used == 'JPEG'
         assert len(compressed) > 0
-    
-    def test_compress_large_image(self):
-        """Large images should be resized to max dimension."""
-        image_bytes = create_test_image(3000, 2000)
-        
-        compressed, format_used, size = compress_image(
-            image_bytes, 
-            max_dimension=(1920, 1920)
-        )
-        
-        # Should be scaled down proportionally
-        assert size[0] <= 1920
-        assert size[1] <= 1920
-    
-    def test_compress_maintains_aspect_ratio(self):
-        """Compression should maintain aspect ratio."""
-        # 2:1 aspect ratio
-        image_bytes = create_test_image(4000, 2000)
-        
-        compressed, format_used, size = compress_image(
-            image_bytes,
-            max_dimension=(1920, 1920)
-        )
-        
-        # Should maintain 2:1 ratio (approximately)
-        ratio = size[0] / size[1]
-        assert 1.9 < ratio < 2.1
-    
-    def test_compress_already_small(self):
-        """Image already smaller than max should not be upscaled."""
-        image_bytes = create_test_image(500, 500)
-        
-        compressed, format_used, size = compress_image(
-            image_bytes,
-            max_dimension=(1920, 1920)
-        )
-        
-        assert size == (500, 500)
 
 
 class TestGenerateThumbnail:
     """Tests for thumbnail generation."""
     
-    def test_thumbnail_size(self):
-        """Thumbnail should be within specified size."""
-        image_bytes = create_test_image(1000, 800)
+    @pytest.mark.parametrize("width, height, check", [
+        # Thumbnail should be within specified size
+        (1000, 800, lambda size: size[0] <= 200 and size[1] <= 200),
+        # Thumbnail should maintain aspect ratio (4:3)
+        (800, 600, lambda size: 1.2 < size[0] / size[1] < 1.4),
+        # Small image thumbnail should not be upscaled
+        (50, 50, lambda size: size == (50, 50)),
+    ], ids=["within_size", "aspect_ratio", "small"])
+    def test_thumbnail(self, width, height, check):
+        """Thumbnails should fit 200x200 without upscaling."""
+        image_bytes = create_test_image(width, height)
         
-        thumbnail, size = generate_thumbnail(
-            image_bytes,
-            size=(200, 200)
-        )
+        thumbnail, size = generate_thumbnail(image_bytes, size=(200, 200))
         
-        assert size[0] <= 200
-        assert size[1] <= 200
+        assert check(size)
         assert len(thumbnail) > 0
-    
-    def test_thumbnail_maintains_aspect_ratio(self):
-        """Thumbnail should maintain aspect ratio."""
-        # 4:3 aspect ratio
-        image_bytes = create_test_image(800, 600)
-        
-        thumbnail, size = generate_thumbnail(
-            image_bytes,
-            size=(200, 200)
-        )
-        
-        # Should maintain 4:3 ratio
-        ratio = size[0] / size[1]
-        assert 1.2 < ratio < 1.4
-    
-    def test_thumbnail_small_image(self):
-        """Small image thumbnail should not be upscaled."""
-        image_bytes = create_test_image(50, 50)
-        
-        thumbnail, size = generate_thumbnail(
-            image_bytes,
-            size=(200, 200)
-        )
-        
-        assert size == (50, 50)
 
 
 class TestProcessApprovedImage:
@@ -158,26 +111,126 @@ class TestProcessApprovedImage:
         # Thumbnail should be much smaller
         assert result.thumbnail_size[0] <= DEFAULT_THUMBNAIL_SIZE[0]
         assert result.thumbnail_size[1] <= DEFAULT_THUMBNAIL_SIZE[1]
+    
+    def test_process_decodes_once(self):
+        """The original bytes should only be decoded a single time."""
+        from unittest.mock import patch
+        
+        image_bytes = create_test_image(1000, 800)
+        
+        with patch('image_processing.Image.open', wraps=Image.open) as mock_open:
+            process_approved_image(image_bytes)
+        
+        assert mock_open.call_count == 1
+    
+    def test_thumbnail_derived_from_compressed(self):
+        """The thumbnail should be resampled from the compressed image."""
+        from unittest.mock import patch
+        import image_processing
+        
+        image_bytes = create_test_image(4000, 3000)
+        
+        with patch(
+            'image_processing._thumbnail_from_img',
+            wraps=image_processing._thumbnail_from_img
+        ) as mock_thumb:
+            result = process_approved_image(image_bytes)
+        
+        source = mock_thumb.call_args[0][0]
+        assert result.compressed_size == (1920, 1440)
+        assert max(source.size) <= DEFAULT_COMPRESSED_MAX_SIZE[0]
+    
+    def test_small_jpeg_passed_through(self):
+        """A small JPEG that already fits should not be re-encoded."""
+        image_bytes = create_test_image(800, 600)
+        
+        result = process_approved_image(image_bytes)
+        
+        assert result.compressed_bytes is image_bytes
+        assert result.compressed_format == 'JPEG'
+        assert result.compressed_size == (800, 600)
+    
+    def test_exact_2x_jpeg_not_passed_through(self):
+        """A small JPEG at twice the max size must be resized, not stored as is."""
+        image_bytes = create_test_image(3840, 3840)
+        
+        result = process_approved_image(image_bytes)
+        
+        assert result.compressed_bytes is not image_bytes
+        assert result.compressed_size == (1920, 1920)
+        assert Image.open(BytesIO(result.compressed_bytes)).size == (1920, 1920)
+    
+    def test_jpeg_with_exif_reencoded(self):
+        """JPEGs carrying EXIF metadata should be re-encoded to strip it."""
+        img = Image.new('RGB', (800, 600), color='blue')
+        exif = Image.Exif()
+        exif[0x010F] = "Camera Maker"
+        output = BytesIO()
+        img.save(output, format='JPEG', exif=exif)
+        image_bytes = output.getvalue()
+        
+        result = process_approved_image(image_bytes)
+        
+        assert result.compressed_bytes is not image_bytes
+        assert 'exif' not in Image.open(BytesIO(result.compressed_bytes)).info
+    
+    @pytest.mark.parametrize("key, save_kwargs", [
+        ("xmp", {"xmp": b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><exif:GPSLatitude>51,30N</exif:GPSLatitude></x:xmpmeta>'}),
+        ("comment", {"comment": b"Shot on Camera Maker"}),
+        ("icc_profile", {"icc_profile": b"fake icc profile"}),
+    ])
+    def test_jpeg_with_metadata_reencoded(self, key, save_kwargs):
+        """XMP, comment and ICC metadata should be stripped like EXIF."""
+        img = Image.new('RGB', (800, 600), color='blue')
+        output = BytesIO()
+        img.save(output, format='JPEG', **save_kwargs)
+        image_bytes = output.getvalue()
+        assert key in Image.open(BytesIO(image_bytes)).info
+        
+        result = process_approved_image(image_bytes)
+        
+        assert result.compressed_bytes is not image_bytes
+        assert key not in Image.open(BytesIO(result.compressed_bytes)).info
+        assert key not in Image.open(BytesIO(result.thumbnail_bytes)).info
+    
+    def test_jpeg_with_iptc_reencoded(self):
+        """A Photoshop/IPTC (APP13) block should prevent pass-through."""
+        image_bytes = create_test_image(800, 600)
+        iptc = b"Photoshop 3.0\x008BIM\x04\x04\x00\x00\x00\x00\x00\x0c\x1c\x02\x50\x00\x07Someone"
+        segment = b"\xff\xed" + (len(iptc) + 2).to_bytes(2, "big") + iptc
+        image_bytes = image_bytes[:2] + segment + image_bytes[2:]
+        assert "photoshop" in Image.open(BytesIO(image_bytes)).info
+        
+        result = process_approved_image(image_bytes)
+        
+        assert result.compressed_bytes is not image_bytes
+        assert "photoshop" not in Image.open(BytesIO(result.compressed_bytes)).info
+        assert b"Someone" not in result.compressed_bytes
+    
+    def test_compress_and_thumbnail_accept_pil_image(self):
+        """Compression and thumbnailing should accept a decoded image."""
+        img = Image.open(BytesIO(create_test_image(1000, 800)))
+        
+        _, format_used, size = compress_image(img.copy(), max_dimension=(500, 500))
+        _, thumb_size = generate_thumbnail(img.copy(), size=(200, 200))
+        
+        assert format_used == 'JPEG'
+        assert size == (500, 400)
+        assert thumb_size == (200, 160)
 
 
 class TestImageFormat:
     """Tests for format detection."""
     
-    def test_detect_jpeg_format(self):
+    def test_detect_jpeg_format(self, jpeg_image):
         """JPEG format should be detected."""
-        image_bytes = create_test_image(100, 100, format='JPEG')
-        img = Image.open(BytesIO(image_bytes))
-        
-        format_detected = get_image_format(img)
+        format_detected = get_image_format(jpeg_image)
         
         assert format_detected == 'JPEG'
     
-    def test_detect_png_format(self):
+    def test_detect_png_format(self, png_image):
         """PNG format should be detected."""
-        image_bytes = create_test_image(100, 100, mode='RGB', format='PNG')
-        img = Image.open(BytesIO(image_bytes))
-        
-        format_detected = get_image_format(img)
+        format_detected = get_image_format(png_image)
         
         assert format_detected == 'PNG'
 
@@ -185,26 +238,17 @@ class TestImageFormat:
 class TestShouldUsePng:
     """Tests for PNG decision logic."""
     
-    def test_rgb_no_png(self):
+    def test_rgb_no_png(self, jpeg_image):
         """RGB images should not use PNG."""
-        image_bytes = create_test_image(100, 100, mode='RGB')
-        img = Image.open(BytesIO(image_bytes))
-        
-        assert should_use_png(img) is False
+        assert should_use_png(jpeg_image) is False
     
-    def test_rgba_with_transparency_uses_png(self):
+    def test_rgba_with_transparency_uses_png(self, rgba_transparent_image):
         """RGBA with transparency should use PNG."""
-        # Create RGBA image with transparency
-        img = Image.new('RGBA', (100, 100), color=(255, 0, 0, 128))
-        
-        assert should_use_png(img) is True
+        assert should_use_png(rgba_transparent_image) is True
     
-    def test_rgba_fully_opaque_no_png(self):
+    def test_rgba_fully_opaque_no_png(self, rgba_opaque_image):
         """RGBA that's fully opaque should not use PNG."""
-        # Create RGBA image that's fully opaque
-        img = Image.new('RGBA', (100, 100), color=(255, 0, 0, 255))
-        
-        assert should_use_png(img) is False
+        assert should_use_png(rgba_opaque_image) is False
 
 
 class TestGetImageInfo:
@@ -221,3 +265,113 @@ class TestGetImageInfo:
         assert info['width'] == 800
         assert info['height'] == 600
         assert info['bytes'] == len(image_bytes)
+
+
+class TestUploadProcessedImages:
+    """Tests for uploading processed images."""
+    
+    def test_uploads_both_versions(self):
+        """Compressed and thumbnail versions should both be uploaded."""
+        from unittest.mock import patch, MagicMock
+        from image_processing import upload_processed_images
+        
+        processed = process_approved_image(create_test_image(1000, 800))
+        bucket = MagicMock()
+        bucket.blob.side_effect = lambda path: MagicMock(name=path)
+        
+        with patch('image_processing.get_storage_bucket', return_value=bucket), \
+             patch('image_processing.transfer_manager.upload_many') as mock_upload:
+            paths = upload_processed_images(processed, "user123", "image1.jpg")
+        
+        assert paths["approved_path"] == "approved/user123/image1.jpg"
+        assert paths["thumbnail_path"] == "thumbnails/user123/image1.jpg"
+        
+        uploads = mock_upload.call_args[0][0]
+        assert [f.getvalue() for f, _ in uploads] == [
+            processed.compressed_bytes,
+            processed.thumbnail_bytes,
+        ]
+        assert [blob.content_type for _, blob in uploads] == ["image/jpg", "image/jpeg"]
+        assert mock_upload.call_args[1]["raise_exception"] is True
+    
+    def test_passthrough_copied_server_side(self):
+        """An unmodified original should be copied rather than uploaded."""
+        from unittest.mock import patch, MagicMock
+        from image_processing import upload_processed_images
+        
+        processed = process_approved_image(create_test_image(800, 600))
+        bucket = MagicMock()
+        
+        with patch('image_processing.get_storage_bucket', return_value=bucket), \
+             patch('image_processing.transfer_manager.upload_many') as mock_upload:
+            upload_processed_images(
+                processed, "user123", "image1",
+                source_path="pending/user123/image1", source_generation=42
+            )
+        
+        bucket.copy_blob.assert_called_once()
+        assert bucket.copy_blob.call_args[0][2] == "approved/user123/image1.jpg"
+        assert bucket.copy_blob.call_args[1]["source_generation"] == 42
+        # Only the thumbnail is uploaded
+        assert len(mock_upload.call_args[0][0]) == 1
+    
+    def test_passthrough_without_generation_uploads_bytes(self):
+        """Without a pinned generation the held bytes should be uploaded."""
+        from unittest.mock import patch, MagicMock
+        from image_processing import upload_processed_images
+        
+        processed = process_approved_image(create_test_image(800, 600))
+        bucket = MagicMock()
+        
+        with patch('image_processing.get_storage_bucket', return_value=bucket), \
+             patch('image_processing.transfer_manager.upload_many') as mock_upload:
+            upload_processed_images(
+                processed, "user123", "image1", source_path="pending/user123/image1"
+            )
+        
+        bucket.copy_blob.assert_not_called()
+        uploads = mock_upload.call_args[0][0]
+        assert uploads[0][0].getvalue() == processed.original_bytes
+    
+    def test_upload_error_propagates(self):
+        """A failed upload should raise so the caller can fall back."""
+        from unittest.mock import patch, MagicMock
+        from image_processing import upload_processed_images
+        
+        processed = process_approved_image(create_test_image(100, 100))
+        
+        with patch('image_processing.get_storage_bucket', return_value=MagicMock()), \
+             patch('image_processing.transfer_manager.upload_many',
+                   side_effect=IOError("upload failed")):
+            with pytest.raises(IOError):
+                upload_processed_images(processed, "user123", "image1")
+
+
+class TestDraftForSize:
+    """Tests for JPEG shrink-on-load."""
+    
+    def test_jpeg_decoded_at_reduced_scale(self):
+        """Large JPEGs should decode at a reduced scale covering the target."""
+        img = Image.open(BytesIO(create_test_image(4000, 3000)))
+        
+        draft_for_size(img, (400, 400))
+        img.load()
+        
+        assert img.size == (1000, 750)
+    
+    def test_png_unchanged(self):
+        """Non-JPEG images should decode at full size."""
+        img = Image.open(BytesIO(create_test_image(4000, 3000, format='PNG')))
+        
+        draft_for_size(img, (400, 400))
+        img.load()
+        
+        assert img.size == (4000, 3000)
+    
+    def test_compress_large_jpeg_exact_size(self):
+        """Shrink-on-load should not change the final compressed size."""
+        image_bytes = create_test_image(4000, 4000)
+        
+        _, _, size = compress_image(image_bytes, max_dimension=(1920, 1920))
+        
+        assert size == (1920, 1920)
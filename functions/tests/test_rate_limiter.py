@@ -2,46 +2,61 @@
 Unit tests for rate limiting module.
 """
 
+import os
+import subprocess
+import sys
+
 import pytest
 from unittest.mock import patch, MagicMock
 from datetime import datetime, timezone, timedelta
 
-import sys
-from pathlib import Path
-
-# Add parent directory to path for imports
-sys.path.insert(0, str(Path(__file__).parent.parent))
+from firebase_admin import firestore
 
+import rate_limiter
+from tests.fake_firestore import FakeDocument
 from rate_limiter import (
     RateLimitType,
     RateLimitConfig,
     RateLimitResult,
     get_rate_limit_config,
     get_window_key,
+    check_rate_limit,
+    check_rate_limit_sliding,
+    check_image_upload_limit,
+    check_report_limit,
+    get_user_rate_limit_status,
+    cleanup_expired_rate_limits,
     DEFAULT_RATE_LIMITS,
 )
 
 
+# Fixed reset time for results that only need a non-null timestamp
+_FIXED_NOW = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Reset the cached rate limit configs and decisions between tests."""
+    get_rate_limit_config.cache_clear()
+    rate_limiter._decision_cache.clear()
+    yield
+    get_rate_limit_config.cache_clear()
+    rate_limiter._decision_cache.clear()
+
+
 class TestRateLimitConfig:
     """Tests for rate limit configuration."""
     
-    def test_default_image_limit(self):
-        """Default image upload limit should be configured."""
-        config = DEFAULT_RATE_LIMITS[RateLimitType.IMAGE_UPLOAD]
-        assert config.limit == 20
-        assert config.window_seconds == 3600  # 1 hour
-    
-    def test_default_text_limit(self):
-        """Default text message limit should be configured."""
-        config = DEFAULT_RATE_LIMITS[RateLimitType.TEXT_MESSAGE]
-        assert config.limit == 60
-        assert config.window_seconds == 60  # 1 minute
-    
-    def test_default_report_limit(self):
-        """Default report limit should be configured."""
-        config = DEFAULT_RATE_LIMITS[RateLimitType.REPORT]
-        assert config.limit == 10
-        assert config.window_seconds == 3600  # 1 hour
+    @pytest.mark.parametrize("limit_type, limit, window_seconds", [
+        (RateLimitType.IMAGE_UPLOAD, 20, 3600),  # 20 per hour
+        (RateLimitType.TEXT_MESSAGE, 60, 60),  # 60 per minute
+        (RateLimitType.REPORT, 10, 3600),  # 10 per hour
+    ])
+    def test_default_limit(self, limit_type, limit, window_seconds):
+        """Default limits should be configured for each action type."""
+        config = DEFAULT_RATE_LIMITS[limit_type]
+        assert config.limit == limit
+        assert config.window_seconds == window_seconds
 
 
 class TestWindowKey:
@@ -101,7 +116,7 @@ class TestRateLimitResult:
             current_count=5,
             limit=20,
             remaining=15,
-            reset_at=datetime.now(timezone.utc),
+            reset_at=_FIXED_NOW,
             window_seconds=3600
         )
         
@@ -115,7 +130,7 @@ class TestRateLimitResult:
             current_count=20,
             limit=20,
             remaining=0,
-            reset_at=datetime.now(timezone.utc),
+            reset_at=_FIXED_NOW,
             window_seconds=3600
         )
         
@@ -126,29 +141,306 @@ class TestRateLimitResult:
 class TestCheckRateLimit:
     """Tests for the check_rate_limit function."""
     
+    @patch('rate_limiter.get_redis_client', return_value=None)
     @patch('rate_limiter.get_firestore_client')
     @patch('rate_limiter.get_timestamp')
-    def test_first_request_allowed(self, mock_timestamp, mock_firestore):
+    def test_first_request_allowed(self, mock_timestamp, mock_firestore, mock_redis, fake_firestore):
         """First request in a window should be allowed."""
         mock_timestamp.return_value = datetime(2024, 1, 15, 10, 0, 0, tzinfo=timezone.utc)
+        mock_firestore.return_value = fake_firestore
         
-        # Mock Firestore
-        mock_db = MagicMock()
-        mock_firestore.return_value = mock_db
+        result = check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+        
+        assert result.allowed is True
+        assert result.current_count == 1
+        window_start = int(mock_timestamp.return_value.timestamp())
+        stored = fake_firestore.collection("rate_limits").docs[f"user123_image_upload_{window_start}"]
+        assert stored["count"] == 1
+        assert stored["userId"] == "user123"
+    
+    @patch('rate_limiter.get_redis_client', return_value=None)
+    @patch('rate_limiter.get_firestore_client')
+    def test_counts_up_to_limit(self, mock_firestore, mock_redis, fake_firestore):
+        """Requests should be allowed up to the limit and denied after."""
+        mock_firestore.return_value = fake_firestore
         
-        mock_doc_ref = MagicMock()
-        mock_db.collection.return_value.document.return_value = mock_doc_ref
+        results = [check_rate_limit("user123", RateLimitType.REPORT) for _ in range(11)]
+        
+        assert all(r.allowed for r in results[:10])
+        assert results[-1].allowed is False
+        assert results[9].remaining == 0
+    
+    @patch('rate_limiter.get_firestore_client')
+    @patch('rate_limiter.check_window_counter')
+    @patch('rate_limiter.get_redis_client')
+    @patch('rate_limiter.get_timestamp')
+    def test_redis_backend_used_when_configured(
+        self, mock_timestamp, mock_redis, mock_counter, mock_firestore
+    ):
+        """Redis should answer the check without touching Firestore."""
+        mock_timestamp.return_value = datetime(2024, 1, 15, 10, 30, 0, tzinfo=timezone.utc)
+        mock_redis.return_value = MagicMock()
+        mock_counter.return_value = (5, True)
         
-        mock_snapshot = MagicMock()
-        mock_snapshot.exists = False
-        mock_doc_ref.get.return_value = mock_snapshot
+        result = check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
         
-        mock_transaction = MagicMock()
-        mock_db.transaction.return_value = mock_transaction
+        window_start = int(datetime(2024, 1, 15, 10, 0, 0, tzinfo=timezone.utc).timestamp())
+        mock_counter.assert_called_once_with(
+            f"rl:user123_image_upload_{window_start}", 20, window_start + 3600, True
+        )
+        assert result.allowed is True
+        assert result.current_count == 5
+        assert result.remaining == 15
+        mock_firestore.assert_not_called()
+    
+    @patch('rate_limiter.get_firestore_client')
+    @patch('rate_limiter.check_window_counter')
+    @patch('rate_limiter.get_redis_client')
+    def test_redis_backend_blocks_at_limit(self, mock_redis, mock_counter, mock_firestore):
+        """A full Redis window should block the request."""
+        mock_redis.return_value = MagicMock()
+        mock_counter.return_value = (20, False)
+        
+        result = check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+        
+        assert result.allowed is False
+        assert result.remaining == 0
+        mock_firestore.assert_not_called()
+    
+    @patch('rate_limiter.get_firestore_client')
+    @patch('rate_limiter.check_window_counter')
+    @patch('rate_limiter.get_redis_client')
+    def test_redis_error_falls_back_to_firestore(self, mock_redis, mock_counter, mock_firestore):
+        """Redis failures should fall back to the Firestore transaction."""
+        import redis
+        
+        mock_redis.return_value = MagicMock()
+        mock_counter.side_effect = redis.ConnectionError("unreachable")
+        mock_firestore.side_effect = RuntimeError("firestore reached")
+        
+        with pytest.raises(RuntimeError, match="firestore reached"):
+            check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+    
+    @patch('rate_limiter.get_redis_client', return_value=None)
+    @patch('rate_limiter.get_firestore_client')
+    def test_firestore_conditional_increment(self, mock_firestore, mock_redis):
+        """Under the limit, the increment should be preconditioned on the read."""
+        mock_db = mock_firestore.return_value
+        mock_doc_ref = mock_db.collection.return_value.document.return_value
+        snapshot = mock_doc_ref.get.return_value
+        snapshot.exists = True
+        snapshot.get.return_value = 3
+        
+        result = check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+        
+        assert result.allowed is True
+        assert result.current_count == 4
+        assert result.remaining == 16
+        mock_db.write_option.assert_called_once_with(last_update_time=snapshot.update_time)
+        written = mock_doc_ref.update.call_args[0][0]
+        assert isinstance(written["count"], firestore.Increment)
+        assert mock_doc_ref.update.call_args[1]["option"] is mock_db.write_option.return_value
+        mock_db.transaction.assert_not_called()
+    
+    @patch('rate_limiter.get_redis_client', return_value=None)
+    @patch('rate_limiter.get_firestore_client')
+    def test_firestore_first_request_creates(self, mock_firestore, mock_redis):
+        """A missing window document should be created, not updated."""
+        mock_doc_ref = mock_firestore.return_value.collection.return_value.document.return_value
+        mock_doc_ref.get.return_value.exists = False
         
-        # The actual function uses transactions which are complex to mock
-        # This test validates the mocking setup
-        # Full integration testing should use Firebase Emulator
+        result = check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+        
+        assert result.allowed is True
+        assert result.current_count == 1
+        mock_doc_ref.create.assert_called_once()
+        mock_doc_ref.update.assert_not_called()
+    
+    @patch('rate_limiter.get_redis_client', return_value=None)
+    @patch('rate_limiter.get_firestore_client')
+    def test_firestore_lost_race_retries(self, mock_firestore, mock_redis):
+        """A failed precondition should re-read and retry."""
+        from google.api_core.exceptions import FailedPrecondition
+        
+        mock_doc_ref = mock_firestore.return_value.collection.return_value.document.return_value
+        snapshot = mock_doc_ref.get.return_value
+        snapshot.exists = True
+        snapshot.get.return_value = 3
+        mock_doc_ref.update.side_effect = [FailedPrecondition("changed"), None]
+        
+        result = check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+        
+        assert result.allowed is True
+        assert mock_doc_ref.get.call_count == 2
+        assert mock_doc_ref.update.call_count == 2
+    
+    @patch('rate_limiter.get_redis_client', return_value=None)
+    @patch('rate_limiter.get_firestore_client')
+    def test_concurrent_write_forces_retry(self, mock_firestore, mock_redis, fake_firestore):
+        """A write landing between read and update should be retried, not lost."""
+        mock_firestore.return_value = fake_firestore
+        check_rate_limit("user123", RateLimitType.REPORT)
+        
+        read = FakeDocument.get
+        raced = []
+        
+        def read_then_race(doc):
+            snapshot = read(doc)
+            if not raced:
+                # Another instance's increment lands after our read
+                raced.append(doc.id)
+                doc.set({"count": firestore.Increment(1)}, merge=True)
+            return snapshot
+        
+        with patch.object(FakeDocument, "get", read_then_race), \
+             patch.object(FakeDocument, "update", autospec=True, side_effect=FakeDocument.update) as update:
+            result = check_rate_limit("user123", RateLimitType.REPORT)
+        
+        assert result.allowed is True
+        assert result.current_count == 3
+        assert update.call_count == 2
+        assert fake_firestore.collection("rate_limits").docs[raced[0]]["count"] == 3
+    
+    @patch('rate_limiter.get_redis_client', return_value=None)
+    @patch('rate_limiter.get_firestore_client')
+    def test_firestore_contention_falls_back_to_transaction(self, mock_firestore, mock_redis):
+        """Losing every race should settle the check in a transaction."""
+        from google.api_core.exceptions import FailedPrecondition
+        
+        mock_doc_ref = mock_firestore.return_value.collection.return_value.document.return_value
+        snapshot = mock_doc_ref.get.return_value
+        snapshot.exists = True
+        snapshot.get.return_value = 3
+        mock_doc_ref.update.side_effect = FailedPrecondition("changed")
+        
+        with patch('rate_limiter._increment_in_transaction', return_value=(5, True)) as mock_txn:
+            result = check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+        
+        assert result.allowed is True
+        assert result.current_count == 5
+        assert mock_doc_ref.update.call_count == rate_limiter.RATE_LIMIT_WRITE_ATTEMPTS
+        mock_txn.assert_called_once()
+        assert mock_txn.call_args.args[3] == 20
+    
+    def test_transaction_respects_limit(self):
+        """The transactional fallback should deny at the limit and admit below it."""
+        snapshot = MagicMock(exists=True)
+        doc_ref = MagicMock()
+        doc_ref.get.return_value = snapshot
+        db = MagicMock()
+        
+        with patch('rate_limiter.firestore.transactional', lambda fn: fn):
+            snapshot.get.return_value = 20
+            assert rate_limiter._increment_in_transaction(db, doc_ref, {}, 20) == (20, False)
+            db.transaction.return_value.set.assert_not_called()
+            
+            snapshot.get.return_value = 19
+            assert rate_limiter._increment_in_transaction(db, doc_ref, {"count": 1}, 20) == (20, True)
+            db.transaction.return_value.set.assert_called_once_with(doc_ref, {"count": 1}, merge=True)
+    
+    @patch('rate_limiter.get_redis_client', return_value=None)
+    @patch('rate_limiter.get_firestore_client')
+    def test_firestore_at_limit_no_write(self, mock_firestore, mock_redis):
+        """A full window should deny without writing."""
+        mock_doc_ref = mock_firestore.return_value.collection.return_value.document.return_value
+        snapshot = mock_doc_ref.get.return_value
+        snapshot.exists = True
+        snapshot.get.return_value = 20
+        
+        result = check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+        
+        assert result.allowed is False
+        assert result.remaining == 0
+        mock_doc_ref.update.assert_not_called()
+        mock_doc_ref.create.assert_not_called()
+    
+    @patch('rate_limiter.get_redis_client', return_value=None)
+    @patch('rate_limiter.get_firestore_client')
+    def test_firestore_check_without_increment_reads_only(self, mock_firestore, mock_redis):
+        """Non-incrementing checks should not write."""
+        mock_doc_ref = mock_firestore.return_value.collection.return_value.document.return_value
+        mock_doc_ref.get.return_value.exists = True
+        mock_doc_ref.get.return_value.get.return_value = 20
+        
+        result = check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD, increment=False)
+        
+        assert result.allowed is False
+        mock_doc_ref.set.assert_not_called()
+        mock_doc_ref.update.assert_not_called()
+    
+    @staticmethod
+    def _shard_snapshots(counts):
+        snapshots = []
+        for count in counts:
+            snapshot = MagicMock()
+            snapshot.exists = count is not None
+            snapshot.get.return_value = count
+            snapshots.append(snapshot)
+        return snapshots
+    
+    @patch('rate_limiter.get_rate_limit_config')
+    @patch('rate_limiter.get_redis_client', return_value=None)
+    @patch('rate_limiter.get_firestore_client')
+    def test_firestore_sharded_counter(self, mock_firestore, mock_redis, mock_config):
+        """Sharded counters should sum all shards and write to just one."""
+        mock_config.return_value = RateLimitConfig(limit=20, window_seconds=3600, shards=4)
+        mock_db = mock_firestore.return_value
+        mock_db.get_all.return_value = self._shard_snapshots((2, 3, None, 1))
+        
+        result = check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+        
+        assert result.allowed is True
+        assert result.current_count == 7
+        assert len(mock_db.get_all.call_args[0][0]) == 4
+        mock_db.transaction.assert_not_called()
+        shard_ref = mock_db.collection.return_value.document.return_value
+        shard_ref.set.assert_called_once()
+        assert isinstance(shard_ref.set.call_args[0][0]["count"], firestore.Increment)
+        assert shard_ref.set.call_args[1] == {"merge": True}
+        document_ids = [c[0][0] for c in mock_db.collection.return_value.document.call_args_list]
+        assert {doc_id.rsplit("_", 1)[1] for doc_id in document_ids[1:]} == {"0", "1", "2", "3"}
+    
+    @patch('rate_limiter.get_rate_limit_config')
+    @patch('rate_limiter.get_redis_client', return_value=None)
+    @patch('rate_limiter.get_firestore_client')
+    def test_firestore_sharded_overshoot_bound(self, mock_firestore, mock_redis, mock_config):
+        """Racing checks may overshoot by the racers minus one, then all deny."""
+        mock_config.return_value = RateLimitConfig(limit=20, window_seconds=3600, shards=4)
+        mock_db = mock_firestore.return_value
+        shard_ref = mock_db.collection.return_value.document.return_value
+        
+        # Two instances both read 19 before either write lands (each
+        # instance has its own decision cache)
+        mock_db.get_all.return_value = self._shard_snapshots((5, 5, 5, 4))
+        for _ in range(2):
+            rate_limiter._decision_cache.clear()
+            assert check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD).allowed is True
+        assert shard_ref.set.call_count == 2
+        
+        # Their writes are visible to the next read, which denies
+        rate_limiter._decision_cache.clear()
+        mock_db.get_all.return_value = self._shard_snapshots((5, 6, 5, 5))
+        result = check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+        
+        assert result.allowed is False
+        assert result.current_count == 21
+        assert shard_ref.set.call_count == 2
+    
+    @patch('rate_limiter.check_window_counter')
+    @patch('rate_limiter.get_redis_client')
+    def test_named_checks_bind_type(self, mock_redis, mock_counter):
+        """Named per-action checks should use their own limit type."""
+        mock_redis.return_value = MagicMock()
+        mock_counter.return_value = (1, True)
+        
+        image = check_image_upload_limit("user123")
+        report = check_report_limit("user123")
+        
+        image_key, report_key = (c[0][0] for c in mock_counter.call_args_list)
+        assert "_image_upload_" in image_key
+        assert "_report_" in report_key
+        assert image.limit == 20
+        assert report.limit == 10
     
     @patch('rate_limiter.get_env_int')
     def test_config_env_override(self, mock_env_int):
@@ -158,3 +450,232 @@ class TestCheckRateLimit:
         config = get_rate_limit_config(RateLimitType.IMAGE_UPLOAD)
         
         assert config.limit == 50
+    
+    @patch('rate_limiter.get_env_int')
+    def test_config_cached_per_type(self, mock_env_int):
+        """Environment overrides should be read once per limit type."""
+        mock_env_int.return_value = 50
+        
+        first = get_rate_limit_config(RateLimitType.IMAGE_UPLOAD)
+        reads = mock_env_int.call_count
+        second = get_rate_limit_config(RateLimitType.IMAGE_UPLOAD)
+        
+        assert first is second
+        assert mock_env_int.call_count == reads
+    
+    @patch('rate_limiter.check_window_counter')
+    @patch('rate_limiter.get_redis_client')
+    def test_recent_denial_skips_backend(self, mock_redis, mock_counter):
+        """A window seen full moments ago should be denied from the cache."""
+        mock_redis.return_value = MagicMock()
+        mock_counter.return_value = (20, False)
+        
+        first = check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+        second = check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+        
+        assert first.allowed is False
+        assert second.allowed is False
+        assert second.remaining == 0
+        assert mock_counter.call_count == 1
+    
+    @patch('rate_limiter.check_window_counter')
+    @patch('rate_limiter.get_redis_client')
+    def test_expired_denial_rechecks_backend(self, mock_redis, mock_counter):
+        """Cached denials should expire after the TTL."""
+        mock_redis.return_value = MagicMock()
+        mock_counter.return_value = (20, False)
+        
+        with patch('rate_limiter.time.monotonic', side_effect=[100.0, 101.0, 101.0]):
+            check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+            check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+        
+        assert mock_counter.call_count == 2
+    
+    @patch('rate_limiter.check_window_counter')
+    @patch('rate_limiter.get_redis_client')
+    def test_allowed_requests_not_short_circuited(self, mock_redis, mock_counter):
+        """Windows below the limit should always reach the backend."""
+        mock_redis.return_value = MagicMock()
+        mock_counter.return_value = (3, True)
+        
+        check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+        check_rate_limit("user123", RateLimitType.IMAGE_UPLOAD)
+        
+        assert mock_counter.call_count == 2
+
+
+class TestRedisOptional:
+    """Tests for running without the redis package."""
+    
+    def test_import_without_redis(self):
+        """rate_limiter should import when redis isn't installed."""
+        code = (
+            "import sys; sys.modules['redis'] = None; "
+            "import rate_limiter; assert rate_limiter.get_redis_client() is None"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True,
+            text=True,
+        )
+        assert result.returncode == 0, result.stderr
+    
+    @patch('redis_rate_limiter.get_env_var', return_value="10.0.0.3")
+    def test_host_ignored_without_redis(self, mock_env_var):
+        """A configured REDIS_HOST should fall back to Firestore without redis."""
+        import redis_rate_limiter
+        
+        with patch('redis_rate_limiter.redis', None), \
+             patch('redis_rate_limiter._redis_client', None):
+            assert redis_rate_limiter.get_redis_client() is None
+
+
+class TestGetRedisClient:
+    """Tests for the lazily created Redis client."""
+    
+    @patch('redis_rate_limiter.get_env_var', return_value="10.0.0.3")
+    def test_concurrent_first_calls_see_scripts(self, mock_env_var):
+        """Concurrent first callers should share one client with its scripts registered."""
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        import redis_rate_limiter
+        
+        mock_redis = MagicMock()
+        client = mock_redis.Redis.return_value
+        client.register_script.side_effect = lambda script: time.sleep(0.01) or MagicMock(return_value=[1, 1])
+        
+        with patch('redis_rate_limiter.redis', mock_redis), \
+             patch('redis_rate_limiter._redis_client', None), \
+             patch('redis_rate_limiter._check_window_script', None), \
+             patch('redis_rate_limiter._check_sliding_script', None):
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                results = list(pool.map(
+                    lambda _: redis_rate_limiter.check_window_counter("key", 10, 0), range(8)
+                ))
+        
+        assert mock_redis.Redis.call_count == 1
+        assert results == [(1, True)] * 8
+
+
+class TestCheckRateLimitSliding:
+    """Tests for the check_rate_limit_sliding function."""
+    
+    @patch('rate_limiter.check_sliding_counter')
+    @patch('rate_limiter.get_redis_client')
+    @patch('rate_limiter.get_timestamp')
+    def test_weights_previous_window(self, mock_timestamp, mock_redis, mock_counter):
+        """The previous window should be weighted by its remaining overlap."""
+        mock_timestamp.return_value = datetime(2024, 1, 15, 10, 15, 0, tzinfo=timezone.utc)
+        mock_redis.return_value = MagicMock()
+        mock_counter.return_value = (12, True)
+        
+        result = check_rate_limit_sliding("user123", RateLimitType.IMAGE_UPLOAD)
+        
+        window_start = int(datetime(2024, 1, 15, 10, 0, 0, tzinfo=timezone.utc).timestamp())
+        mock_counter.assert_called_once_with(
+            f"rl:user123_image_upload_{window_start}",
+            f"rl:user123_image_upload_{window_start - 3600}",
+            20,
+            0.75,
+            window_start + 7200,
+            True
+        )
+        assert result.allowed is True
+        assert result.remaining == 8
+    
+    @patch('rate_limiter.check_rate_limit')
+    @patch('rate_limiter.get_redis_client', return_value=None)
+    def test_falls_back_without_redis(self, mock_redis, mock_check):
+        """Without Redis the fixed-window check should be used."""
+        check_rate_limit_sliding("user123", RateLimitType.REPORT, increment=False)
+        
+        mock_check.assert_called_once_with("user123", RateLimitType.REPORT, False)
+
+
+class TestGetUserRateLimitStatus:
+    """Tests for the get_user_rate_limit_status function."""
+    
+    @patch('rate_limiter.get_redis_client', return_value=None)
+    @patch('rate_limiter.get_firestore_client')
+    @patch('rate_limiter.get_timestamp')
+    def test_batched_read_without_transaction(self, mock_timestamp, mock_firestore, mock_redis):
+        """All window documents should be read with a single get_all call."""
+        mock_timestamp.return_value = datetime(2024, 1, 15, 10, 30, 0, tzinfo=timezone.utc)
+        window_start = int(datetime(2024, 1, 15, 10, 0, 0, tzinfo=timezone.utc).timestamp())
+        
+        mock_db = MagicMock()
+        mock_firestore.return_value = mock_db
+        
+        image_snapshot = MagicMock()
+        image_snapshot.id = f"user123_image_upload_{window_start}"
+        image_snapshot.exists = True
+        image_snapshot.get.return_value = 5
+        missing_snapshot = MagicMock()
+        missing_snapshot.id = f"user123_report_{window_start}"
+        missing_snapshot.exists = False
+        mock_db.get_all.return_value = [missing_snapshot, image_snapshot]
+        
+        status = get_user_rate_limit_status("user123")
+        
+        mock_db.get_all.assert_called_once()
+        assert len(mock_db.get_all.call_args[0][0]) == len(RateLimitType)
+        mock_db.transaction.assert_not_called()
+        
+        assert status["image_upload"]["current"] == 5
+        assert status["image_upload"]["remaining"] == 15
+        assert status["image_upload"]["resetAt"] == "2024-01-15T11:00:00+00:00"
+        assert status["report"]["current"] == 0
+        assert status["text_message"]["current"] == 0
+        assert status["text_message"]["remaining"] == 60
+    
+    @patch('rate_limiter.get_redis_client', return_value=None)
+    @patch('rate_limiter.get_firestore_client')
+    @patch('rate_limiter.get_timestamp')
+    @patch('rate_limiter.get_env_int')
+    def test_sharded_counts_summed(self, mock_env_int, mock_timestamp, mock_firestore, mock_redis):
+        """Shards of the same window should be summed into one status."""
+        mock_env_int.side_effect = lambda name, default: 2 if name == "RATE_LIMIT_COUNTER_SHARDS" else default
+        mock_timestamp.return_value = datetime(2024, 1, 15, 10, 30, 0, tzinfo=timezone.utc)
+        window_start = int(datetime(2024, 1, 15, 10, 0, 0, tzinfo=timezone.utc).timestamp())
+        
+        mock_db = MagicMock()
+        mock_firestore.return_value = mock_db
+        
+        snapshots = []
+        for shard, count in ((0, 4), (1, 3)):
+            snapshot = MagicMock()
+            snapshot.id = f"user123_image_upload_{window_start}_{shard}"
+            snapshot.exists = True
+            snapshot.get.return_value = count
+            snapshots.append(snapshot)
+        mock_db.get_all.return_value = snapshots
+        
+        status = get_user_rate_limit_status("user123")
+        
+        assert len(mock_db.get_all.call_args[0][0]) == 2 * len(RateLimitType)
+        assert status["image_upload"]["current"] == 7
+        assert status["report"]["current"] == 0
+
+
+class TestCleanupExpiredRateLimits:
+    """Tests for the cleanup_expired_rate_limits function."""
+    
+    @patch('rate_limiter.get_firestore_client')
+    def test_projects_names_and_bulk_deletes(self, mock_firestore):
+        """Cleanup should stream names only and delete through a BulkWriter."""
+        mock_db = MagicMock()
+        mock_firestore.return_value = mock_db
+        
+        query = mock_db.collection.return_value.where.return_value
+        docs = [MagicMock() for _ in range(3)]
+        query.select.return_value.stream.return_value = docs
+        
+        deleted = cleanup_expired_rate_limits(days_old=1)
+        
+        assert deleted == 3
+        query.select.assert_called_once_with(["__name__"])
+        bulk_writer = mock_db.bulk_writer.return_value
+        assert bulk_writer.delete.call_count == 3
+        bulk_writer.close.assert_called_once()
+        mock_db.batch.assert_not_called()
@@ -4,21 +4,23 @@ Unit tests for reporting module.
 
 import pytest
 from unittest.mock import patch, MagicMock
-
-import sys
-from pathlib import Path
-
-# Add parent directory to path for imports
-sys.path.insert(0, str(Path(__file__).parent.parent))
+from datetime import datetime, timezone
 
 from reporting import (
     validate_report_category,
     submit_report,
+    get_report_stats,
+    get_pending_reports,
+    iter_pending_reports,
     ReportResult,
 )
 from utils import ReportCategory
 
 
+# Fixed reset time for results that only need a non-null timestamp
+_FIXED_NOW = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
 class TestValidateReportCategory:
     """Tests for category validation."""
     
@@ -47,18 +49,12 @@ class TestSubmitReport:
     
     @patch('reporting.check_report_limit')
     @patch('reporting.get_firestore_client')
-    def test_submit_valid_report(self, mock_firestore, mock_rate_limit):
+    def test_submit_valid_report(self, mock_firestore, mock_rate_limit, fake_firestore):
         """Valid report should be submitted successfully."""
         # Mock rate limit - allowed
         mock_rate_limit.return_value = MagicMock(allowed=True)
         
-        # Mock Firestore
-        mock_db = MagicMock()
-        mock_firestore.return_value = mock_db
-        
-        mock_doc = MagicMock()
-        mock_doc.id = "report123"
-        mock_db.collection.return_value.add.return_value = (None, mock_doc)
+        mock_firestore.return_value = fake_firestore
         
         result = submit_report(
             reporter_id="user123",
@@ -68,8 +64,11 @@ class TestSubmitReport:
         )
         
         assert result.success is True
-        assert result.report_id == "report123"
+        assert result.report_id == "reports1"
         assert result.error is None
+        stored = fake_firestore.collection("reports").docs["reports1"]
+        assert stored["category"] == "spam"
+        assert stored["description"] == "This is spam"
     
     def test_invalid_category_rejected(self):
         """Invalid category should be rejected."""
@@ -85,12 +84,10 @@ class TestSubmitReport:
     @patch('reporting.check_report_limit')
     def test_rate_limit_exceeded(self, mock_rate_limit):
         """Rate limited user should be rejected."""
-        from datetime import datetime, timezone
-        
         mock_rate_limit.return_value = MagicMock(
             allowed=False,
             limit=10,
-            reset_at=datetime.now(timezone.utc)
+            reset_at=_FIXED_NOW
         )
         
         result = submit_report(
@@ -118,19 +115,15 @@ class TestSubmitReport:
         
         assert result.success is False
         assert "too long" in result.error.lower()
+        mock_rate_limit.assert_not_called()
     
     @patch('reporting.check_report_limit')
     @patch('reporting.get_firestore_client')
-    def test_optional_description(self, mock_firestore, mock_rate_limit):
+    def test_optional_description(self, mock_firestore, mock_rate_limit, fake_firestore):
         """Report without description should succeed."""
         mock_rate_limit.return_value = MagicMock(allowed=True)
         
-        mock_db = MagicMock()
-        mock_firestore.return_value = mock_db
-        
-        mock_doc = MagicMock()
-        mock_doc.id = "report123"
-        mock_db.collection.return_value.add.return_value = (None, mock_doc)
+        mock_firestore.return_value = fake_firestore
         
         result = submit_report(
             reporter_id="user123",
@@ -140,6 +133,7 @@ class TestSubmitReport:
         )
         
         assert result.success is True
+        assert "description" not in fake_firestore.collection("reports").docs[result.report_id]
 
 
 class TestReportCategories:
@@ -153,3 +147,111 @@ class TestReportCategories:
         assert "harassment" in categories
         assert "inappropriate" in categories
         assert "other" in categories
+
+
+class TestGetReportStats:
+    """Tests for the get_report_stats function."""
+    
+    @patch('reporting.get_firestore_client')
+    def test_uses_count_aggregation(self, mock_firestore):
+        """Counts should come from aggregation queries, not streamed documents."""
+        mock_db = MagicMock()
+        mock_firestore.return_value = mock_db
+        
+        pending_query = MagicMock()
+        mock_db.collection.return_value.where.return_value = pending_query
+        pending_query.count.return_value.get.return_value = [[MagicMock(value=7)]]
+        
+        category_query = MagicMock()
+        pending_query.where.return_value = category_query
+        category_query.count.return_value.get.return_value = [[MagicMock(value=2)]]
+        
+        stats = get_report_stats()
+        
+        assert stats["pendingCount"] == 7
+        assert stats["byCategory"] == {c.value: 2 for c in ReportCategory}
+        pending_query.stream.assert_not_called()
+        category_query.stream.assert_not_called()
+
+
+class TestGetPendingReports:
+    """Tests for the get_pending_reports function."""
+    
+    @patch('reporting.get_firestore_client')
+    def test_first_page(self, mock_firestore):
+        """Without a cursor the ordered query should just be limited."""
+        mock_db = MagicMock()
+        mock_firestore.return_value = mock_db
+        ordered = mock_db.collection.return_value.where.return_value.order_by.return_value
+        doc = MagicMock(id="r1")
+        doc.to_dict.return_value = {"category": "spam"}
+        ordered.limit.return_value.stream.return_value = [doc]
+        
+        reports = get_pending_reports(limit=10)
+        
+        ordered.limit.assert_called_once_with(10)
+        ordered.start_after.assert_not_called()
+        assert reports == [{"category": "spam", "id": "r1"}]
+    
+    @patch('reporting.get_firestore_client')
+    def test_start_after_cursor(self, mock_firestore):
+        """A cursor ID should continue after that report's snapshot."""
+        mock_db = MagicMock()
+        mock_firestore.return_value = mock_db
+        ordered = mock_db.collection.return_value.where.return_value.order_by.return_value
+        cursor = mock_db.collection.return_value.document.return_value.get.return_value
+        cursor.exists = True
+        ordered.start_after.return_value.limit.return_value.stream.return_value = []
+        
+        get_pending_reports(limit=10, start_after="r1")
+        
+        mock_db.collection.return_value.document.assert_called_once_with("r1")
+        ordered.start_after.assert_called_once_with(cursor)
+        ordered.start_after.return_value.limit.assert_called_once_with(10)
+    
+    @patch('reporting.get_firestore_client')
+    def test_missing_cursor_raises(self, mock_firestore):
+        """A cursor whose report was deleted shouldn't restart at page one."""
+        mock_db = MagicMock()
+        mock_firestore.return_value = mock_db
+        ordered = mock_db.collection.return_value.where.return_value.order_by.return_value
+        mock_db.collection.return_value.document.return_value.get.return_value.exists = False
+        
+        with pytest.raises(ValueError):
+            get_pending_reports(limit=10, start_after="gone")
+        
+        ordered.limit.assert_not_called()
+        ordered.start_after.assert_not_called()
+    
+    @patch('reporting.get_firestore_client')
+    def test_iter_missing_cursor_raises_on_call(self, mock_firestore):
+        """The cursor check should fail at call time, before iteration."""
+        mock_db = MagicMock()
+        mock_firestore.return_value = mock_db
+        mock_db.collection.return_value.document.return_value.get.return_value.exists = False
+        
+        with pytest.raises(ValueError):
+            iter_pending_reports(limit=10, start_after="gone")
+    
+    @patch('reporting.get_firestore_client')
+    def test_iter_is_lazy(self, mock_firestore):
+        """Reports should be yielded as documents are streamed."""
+        mock_db = MagicMock()
+        mock_firestore.return_value = mock_db
+        ordered = mock_db.collection.return_value.where.return_value.order_by.return_value
+        
+        consumed = []
+        
+        def stream():
+            for report_id in ("r1", "r2"):
+                consumed.append(report_id)
+                doc = MagicMock(id=report_id)
+                doc.to_dict.return_value = {}
+                yield doc
+        
+        ordered.limit.return_value.stream.side_effect = stream
+        
+        reports = iter_pending_reports(limit=10)
+        
+        assert next(reports) == {"id": "r1"}
+        assert consumed == ["r1"]
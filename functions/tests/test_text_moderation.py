@@ -2,31 +2,35 @@
 Unit tests for text moderation module.
 """
 
+import os
 import pytest
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch, MagicMock
 
-import sys
-from pathlib import Path
-
-# Add parent directory to path for imports
-sys.path.insert(0, str(Path(__file__).parent.parent))
-
+import text_moderation
 from text_moderation import TextModerator, TextModerationResult
 
 
 class TestTextModerator:
     """Tests for TextModerator class."""
     
-    @pytest.fixture
-    def moderator(self):
-        """Create a moderator with default blocklist."""
+    @pytest.fixture(scope="class")
+    def shared_moderator(self):
+        """Create one moderator with the default blocklist for the class."""
         return TextModerator()
     
+    @pytest.fixture
+    def moderator(self, shared_moderator):
+        """Shared moderator, with blocklist changes undone after each test."""
+        original = shared_moderator.blocklist
+        yield shared_moderator
+        shared_moderator.set_blocklist(original)
+    
     def test_empty_text_allowed(self, moderator):
         """Empty text should be allowed."""
         result = moderator.moderate("")
         assert result.allowed is True
-        assert result.matched_terms == []
+        assert result.matched_terms == ()
     
     def test_whitespace_only_allowed(self, moderator):
         """Whitespace-only text should be allowed."""
@@ -37,12 +41,12 @@ class TestTextModerator:
         """Normal, clean text should be allowed."""
         result = moderator.moderate("Hello, how are you doing today?")
         assert result.allowed is True
-        assert result.matched_terms == []
+        assert result.matched_terms == ()
     
     def test_blocklist_word_blocked(self, moderator):
         """Text containing blocklist words should be blocked."""
         # Add a test word to blocklist
-        moderator.blocklist.add("badword")
+        moderator.set_blocklist(moderator.blocklist | {"badword"})
         
         result = moderator.moderate("This contains badword in it")
         assert result.allowed is False
@@ -50,7 +54,7 @@ class TestTextModerator:
     
     def test_blocklist_case_insensitive(self, moderator):
         """Blocklist matching should be case insensitive."""
-        moderator.blocklist.add("badword")
+        moderator.set_blocklist(moderator.blocklist | {"badword"})
         
         result = moderator.moderate("This contains BADWORD in it")
         assert result.allowed is False
@@ -60,7 +64,7 @@ class TestTextModerator:
     
     def test_blocklist_phrase_blocked(self, moderator):
         """Multi-word phrases in blocklist should be blocked."""
-        moderator.blocklist.add("bad phrase here")
+        moderator.set_blocklist(moderator.blocklist | {"bad phrase here"})
         
         result = moderator.moderate("This contains bad phrase here obviously")
         assert result.allowed is False
@@ -68,7 +72,7 @@ class TestTextModerator:
     
     def test_word_boundary_respected(self, moderator):
         """Blocklist words should match on word boundaries."""
-        moderator.blocklist.add("ass")
+        moderator.set_blocklist(moderator.blocklist | {"ass"})
         
         # Should match standalone word
         result = moderator.moderate("what an ass")
@@ -78,6 +82,26 @@ class TestTextModerator:
         # This depends on word boundary implementation
         # For safety, we use whole-word matching
     
+    def test_blocklist_word_inside_other_word_not_matched(self, moderator):
+        """Single blocklist words should not match inside longer words."""
+        moderator.set_blocklist(moderator.blocklist | {"badword"})
+        
+        result = moderator.moderate("superbadwordy and badwords")
+        assert "badword" not in result.matched_terms
+        
+        result = moderator.moderate("(badword)")
+        assert "badword" in result.matched_terms
+    
+    def test_blocklist_changes_after_first_use(self, moderator):
+        """Terms added or removed after moderating should take effect."""
+        assert moderator.moderate("hello zzterm").allowed is True
+        
+        moderator.set_blocklist(moderator.blocklist | {"zzterm"})
+        assert moderator.moderate("hello zzterm").allowed is False
+        
+        moderator.set_blocklist(moderator.blocklist - {"zzterm"})
+        assert moderator.moderate("hello zzterm").allowed is True
+    
     def test_spaced_profanity_blocked(self, moderator):
         """Spaced out letters should be caught by regex."""
         result = moderator.moderate("f u c k you")
@@ -100,6 +124,72 @@ class TestTextModerator:
         result = moderator.moderate("I'm gonna kill you")
         assert result.allowed is False
     
+    def test_each_regex_category_reported_once(self, moderator):
+        """Overlapping patterns of one category yield a single match."""
+        result = moderator.moderate("f u c k, fuck, sh1t and kys")
+        regex_terms = [t for t in result.matched_terms if t.startswith("regex:")]
+        assert regex_terms == ["regex:profanity", "regex:self-harm encouragement"]
+    
+    @pytest.mark.skipif(text_moderation.hyperscan is None, reason="hyperscan not installed")
+    def test_hyperscan_scan_matches_fallback(self, moderator):
+        """The Hyperscan pass should agree with the re/ahocorasick checks."""
+        moderator.set_blocklist(moderator.blocklist | {"café", "a.b"})
+        texts = [
+            "PORN site", "pornography", "xxxl", "Café au lait", "cafés", "xa.b a.b",
+            "f u c k, sh1t", "just kys", "I'll kill you", "hello there",
+        ]
+        for text in texts:
+            term_text, pattern_text = moderator._normalize_text(text)
+            expected = (
+                moderator._check_blocklist(term_text),
+                moderator._check_regex_patterns(pattern_text),
+            )
+            assert moderator._scan(term_text, pattern_text) == expected, text
+    
+    @pytest.mark.skipif(text_moderation.hyperscan is None, reason="hyperscan not installed")
+    def test_hyperscan_folds_case_like_fallback(self, moderator):
+        """Both backends should give the same result on case-folded evasions."""
+        with patch("text_moderation.hyperscan", None):
+            fallback = TextModerator()
+        for text in ["ſhit", "aſſ", "shıt", "İ'll kill you", "İkys", "kİll yourself", "İ"]:
+            expected = fallback.moderate(text)
+            result = moderator.moderate(text)
+            assert result.allowed == expected.allowed, text
+            assert result.matched_terms == expected.matched_terms, text
+    
+    def test_fallback_without_hyperscan(self):
+        """Moderation should still work when hyperscan is unavailable."""
+        with patch("text_moderation.hyperscan", None):
+            moderator = TextModerator()
+            assert moderator.moderate("just kys already").allowed is False
+            assert moderator.moderate("Hello there").allowed is True
+
+    def test_fallback_folds_case_like_ignorecase(self):
+        """Letters re.IGNORECASE folds to ASCII shouldn't evade the fallback."""
+        with patch("text_moderation.hyperscan", None):
+            moderator = TextModerator()
+            for text in ["ſhit", "aſſ", "shıt", "İ'll kill you", "KYS"]:
+                assert moderator.moderate(text).allowed is False, text
+            assert moderator.moderate("shit").allowed is False
+
+    def test_repeated_text_served_from_cache(self, moderator):
+        """A repeated message should reuse the cached result."""
+        first = moderator.moderate("see you at noon")
+        hits = moderator.cache_info().hits
+        
+        assert moderator.moderate("see you at noon") is first
+        assert moderator.cache_info().hits == hits + 1
+    
+    def test_cached_result_terms_immutable(self, moderator):
+        """Cached results are shared, so their matched terms can't be edited."""
+        result = moderator.moderate("just kys already")
+        assert isinstance(result.matched_terms, tuple)
+    
+    def test_long_text_not_cached(self, moderator):
+        """Texts over the length limit should bypass the cache."""
+        text = "a" * (text_moderation.MODERATION_CACHE_MAX_TEXT_LENGTH + 1)
+        assert moderator.moderate(text) is not moderator.moderate(text)
+    
     def test_result_contains_original_text(self, moderator):
         """Result should contain the original text."""
         text = "Test message"
@@ -108,8 +198,7 @@ class TestTextModerator:
     
     def test_multiple_violations(self, moderator):
         """Text with multiple violations should catch all."""
-        moderator.blocklist.add("word1")
-        moderator.blocklist.add("word2")
+        moderator.set_blocklist(moderator.blocklist | {"word1", "word2"})
         
         result = moderator.moderate("word1 and also word2")
         assert result.allowed is False
@@ -120,10 +209,8 @@ class TestTextModerator:
 class TestValidateTextFunction:
     """Tests for the validate_text function."""
     
-    @patch('text_moderation.log_moderation_event')
-    @patch('text_moderation.log_blocked_content')
-    @patch('text_moderation.increment_user_violations')
-    def test_validate_clean_text(self, mock_increment, mock_log_blocked, mock_log_event):
+    @patch('text_moderation.write_moderation_batch')
+    def test_validate_clean_text(self, mock_write):
         """Clean text should be allowed."""
         from text_moderation import validate_text
         
@@ -133,19 +220,19 @@ class TestValidateTextFunction:
         )
         
         assert result["allowed"] is True
-        mock_log_event.assert_called_once()
-        mock_log_blocked.assert_not_called()
-        mock_increment.assert_not_called()
-    
-    @patch('text_moderation.log_moderation_event')
-    @patch('text_moderation.log_blocked_content')
-    @patch('text_moderation.increment_user_violations')
-    def test_validate_blocked_text(self, mock_increment, mock_log_blocked, mock_log_event):
+        log_entries, blocked_entries, violations = mock_write.call_args.args
+        assert len(log_entries) == 1
+        assert blocked_entries == []
+        assert not violations
+    
+    @patch('text_moderation.write_moderation_batch')
+    def test_validate_blocked_text(self, mock_write):
         """Blocked text should trigger logging."""
         from text_moderation import validate_text, get_text_moderator
         
         # Add a test word
-        get_text_moderator().blocklist.add("testblock")
+        moderator = get_text_moderator()
+        moderator.set_blocklist(moderator.blocklist | {"testblock"})
         
         result = validate_text(
             text="This has testblock in it",
@@ -154,9 +241,68 @@ class TestValidateTextFunction:
         
         assert result["allowed"] is False
         assert result["reason"] is not None
-        mock_log_event.assert_called_once()
-        mock_log_blocked.assert_called_once()
-        mock_increment.assert_called_once()
+        log_entries, blocked_entries, violations = mock_write.call_args.args
+        assert len(log_entries) == 1
+        assert len(blocked_entries) == 1
+        assert violations == {"user123": 1}
+    
+    @patch('text_moderation.write_moderation_batch')
+    def test_verbose_logging_disabled(self, mock_write, monkeypatch):
+        """Original text should be left out of logs when VERBOSE_LOGGING is off."""
+        from text_moderation import validate_text, verbose_logging_enabled
+        
+        monkeypatch.setenv("VERBOSE_LOGGING", "false")
+        verbose_logging_enabled.cache_clear()
+        try:
+            validate_text(text="Hello world", user_id="user123")
+        finally:
+            verbose_logging_enabled.cache_clear()
+        
+        log_entries = mock_write.call_args.args[0]
+        assert "originalContent" not in log_entries[0]
+    
+    @patch('utils.get_firestore_client')
+    def test_writes_committed_before_response(self, mock_firestore, fake_firestore):
+        """The log, blocked content and violation should land in one commit before returning."""
+        from text_moderation import validate_text
+        
+        mock_firestore.return_value = fake_firestore
+        
+        result = validate_text(text="just kys", user_id="user123")
+        
+        assert result["allowed"] is False
+        assert len(fake_firestore.collection("moderation_logs").docs) == 1
+        assert len(fake_firestore.collection("blocked_content").docs) == 1
+        violations = fake_firestore.collection("user_violations").docs
+        assert violations["user123"]["violationCount"] == 1
+        assert fake_firestore.commits == 1
+
+
+class TestValidateTextBatch:
+    """Tests for the validate_text_batch function."""
+    
+    @patch('utils.get_firestore_client')
+    def test_batch_writes_logs_and_coalesces_violations(self, mock_firestore, fake_firestore):
+        """All writes should go through batches, one violation update per user."""
+        from text_moderation import validate_text_batch
+        
+        mock_firestore.return_value = fake_firestore
+        fake_firestore.collection("user_violations").document("user1").set({"violationCount": 2})
+        
+        results = validate_text_batch([
+            ("user1", "just kys", None),
+            ("user1", "Hello there", "conv1"),
+            ("user1", "kys", None),
+            ("user2", "kys", "conv2"),
+        ])
+        
+        assert [r["allowed"] for r in results] == [False, True, False, False]
+        assert len(fake_firestore.collection("moderation_logs").docs) == 4
+        assert len(fake_firestore.collection("blocked_content").docs) == 3
+        violations = fake_firestore.collection("user_violations").docs
+        assert violations["user1"]["violationCount"] == 4
+        assert violations["user2"]["violationCount"] == 1
+        assert fake_firestore.commits == 1
 
 
 class TestBlocklistLoading:
@@ -166,10 +312,57 @@ class TestBlocklistLoading:
         """Loading a nonexistent file should not crash."""
         moderator = TextModerator("/nonexistent/path/blocklist.txt")
         # Should have empty blocklist
-        assert isinstance(moderator.blocklist, set)
+        assert moderator.blocklist == frozenset()
+    
+    def test_load_blocklist_file(self, tmp_path):
+        """Entries should be lowercased, skipping comments and blank lines."""
+        path = tmp_path / "blocklist.txt"
+        path.write_text("# comment\n\nBadWord\n  bad phrase  \n", encoding="utf-8")
+        
+        moderator = TextModerator(str(path))
+        
+        assert moderator.blocklist == {"badword", "bad phrase"}
+
+
+class TestGetTextModerator:
+    """Tests for the global moderator instance."""
+    
+    def test_concurrent_first_calls_build_once(self):
+        """Concurrent first calls should share one moderator."""
+        with patch("text_moderation._moderator", None), \
+                patch("text_moderation.TextModerator", wraps=TextModerator) as mock_cls:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                moderators = list(pool.map(lambda _: text_moderation.get_text_moderator(), range(8)))
+        
+        assert mock_cls.call_count == 1
+        assert all(m is moderators[0] for m in moderators)
     
-    def test_load_default_blocklist(self):
-        """Default blocklist should load successfully."""
-        moderator = TextModerator()
-        # Should have some entries from default blocklist
-        assert len(moderator.blocklist) >= 0  # May be empty in test environment
+    def test_reload_skips_unchanged_file(self, tmp_path):
+        """Reloading an unchanged file should keep the current moderator."""
+        path = tmp_path / "blocklist.txt"
+        path.write_text("first\n", encoding="utf-8")
+        
+        with patch("text_moderation._moderator", None):
+            text_moderation.reload_blocklist(str(path))
+            moderator = text_moderation.get_text_moderator()
+            
+            text_moderation.reload_blocklist(str(path))
+            assert text_moderation.get_text_moderator() is moderator
+            
+            path.write_text("first\nsecond\n", encoding="utf-8")
+            os.utime(path, (0, 0))
+            text_moderation.reload_blocklist(str(path))
+            assert text_moderation.get_text_moderator().blocklist == {"first", "second"}
+    
+    def test_reload_discards_runtime_edits(self, tmp_path):
+        """Reloading should drop terms added at runtime even if the file is unchanged."""
+        path = tmp_path / "blocklist.txt"
+        path.write_text("first\n", encoding="utf-8")
+        
+        with patch("text_moderation._moderator", None):
+            text_moderation.reload_blocklist(str(path))
+            moderator = text_moderation.get_text_moderator()
+            moderator.set_blocklist(moderator.blocklist | {"extra"})
+            
+            text_moderation.reload_blocklist(str(path))
+            assert text_moderation.get_text_moderator().blocklist == {"first"}
@@ -2,7 +2,10 @@
 Shared utilities for the content moderation system.
 """
 
+import functools
 import os
+import threading
+from collections import Counter
 from datetime import datetime, timezone
 from typing import Any, Optional
 from enum import Enum
@@ -38,31 +41,48 @@ class ReportStatus(Enum):
     REVIEWED = "reviewed"
 
 
+# Maximum number of writes in one Firestore batch
+FIRESTORE_BATCH_LIMIT = 500
+
+
 # Initialize Firebase Admin SDK (only once)
 _app_initialized = False
+_app_lock = threading.Lock()
 
 
 def initialize_firebase() -> None:
     """Initialize Firebase Admin SDK if not already initialized."""
     global _app_initialized
     if not _app_initialized:
-        try:
-            firebase_admin.get_app()
-        except ValueError:
-            # App not initialized, initialize it
-            firebase_admin.initialize_app()
-        _app_initialized = True
+        with _app_lock:
+            if not _app_initialized:
+                try:
+                    firebase_admin.get_app()
+                except ValueError:
+                    # App not initialized, initialize it
+                    firebase_admin.initialize_app()
+                _app_initialized = True
 
 
+@functools.cache
 def get_firestore_client() -> firestore.Client:
-    """Get Firestore client instance."""
+    """Get Firestore client instance (created once, then reused)."""
     initialize_firebase()
     return firestore.client()
 
 
 def get_storage_bucket(bucket_name: Optional[str] = None) -> storage.bucket:
-    """Get Firebase Storage bucket instance."""
+    """Get Firebase Storage bucket instance (one per bucket name)."""
     initialize_firebase()
+    if bucket_name is None:
+        # Resolve the default so it shares a cache entry with its explicit name
+        bucket_name = firebase_admin.get_app().options.get('storageBucket')
+    return _get_bucket(bucket_name)
+
+
+@functools.cache
+def _get_bucket(bucket_name: Optional[str]) -> storage.bucket:
+    """Create the bucket handle for a resolved bucket name."""
     return storage.bucket(bucket_name)
 
 
@@ -82,6 +102,16 @@ def get_env_bool(name: str, default: bool = False) -> bool:
     return value in ('true', '1', 'yes')
 
 
+@functools.lru_cache(maxsize=1)
+def verbose_logging_enabled() -> bool:
+    """
+    Whether to store original content in logs (VERBOSE_LOGGING).
+    
+    Read once per instance; the environment doesn't change at runtime.
+    """
+    return get_env_bool("VERBOSE_LOGGING", True)
+
+
 def get_env_int(name: str, default: int) -> int:
     """Get environment variable as integer."""
     try:
@@ -115,7 +145,29 @@ def log_moderation_event(
         The document ID of the created log entry
     """
     db = get_firestore_client()
+    log_data = moderation_event_data(
+        user_id, content_type, action, reason,
+        confidence, original_content, additional_data
+    )
+    doc_ref = db.collection("moderation_logs").add(log_data)
+    return doc_ref[1].id
+
+
+def moderation_event_data(
+    user_id: str,
+    content_type: ContentType,
+    action: ModerationAction,
+    reason: str,
+    confidence: Optional[dict] = None,
+    original_content: Optional[str] = None,
+    additional_data: Optional[dict] = None
+) -> dict:
+    """
+    Build a moderation_logs document (see log_moderation_event).
     
+    Returns:
+        Document data for the log entry
+    """
     log_data = {
         "userId": user_id,
         "contentType": content_type.value,
@@ -133,8 +185,7 @@ def log_moderation_event(
     if additional_data:
         log_data.update(additional_data)
     
-    doc_ref = db.collection("moderation_logs").add(log_data)
-    return doc_ref[1].id
+    return log_data
 
 
 def log_blocked_content(
@@ -156,52 +207,89 @@ def log_blocked_content(
         The document ID of the created entry
     """
     db = get_firestore_client()
+    doc_data = blocked_content_data(user_id, content_type, original_path, reason)
+    doc_ref = db.collection("blocked_content").add(doc_data)
+    return doc_ref[1].id
+
+
+def blocked_content_data(
+    user_id: str,
+    content_type: ContentType,
+    original_path: str,
+    reason: str
+) -> dict:
+    """
+    Build a blocked_content document (see log_blocked_content).
     
-    doc_data = {
+    Returns:
+        Document data for the entry
+    """
+    return {
         "userId": user_id,
         "contentType": content_type.value,
         "originalPath": original_path,
         "reason": reason,
         "timestamp": get_timestamp(),
     }
-    
-    doc_ref = db.collection("blocked_content").add(doc_data)
-    return doc_ref[1].id
 
 
-def increment_user_violations(user_id: str) -> int:
+def increment_user_violations(user_id: str) -> None:
     """
     Increment violation count for a user.
     
+    A single write with a server-side Increment, so there's no read and
+    concurrent violations for the same user don't contend.
+    
     Args:
         user_id: The ID of the user
-        
-    Returns:
-        The new violation count
     """
     db = get_firestore_client()
-    doc_ref = db.collection("user_violations").document(user_id)
-    
-    # Use transaction to safely increment
-    @firestore.transactional
-    def update_in_transaction(transaction, doc_ref):
-        snapshot = doc_ref.get(transaction=transaction)
-        if snapshot.exists:
-            current_count = snapshot.get("violationCount") or 0
-            new_count = current_count + 1
-        else:
-            new_count = 1
-        
-        transaction.set(doc_ref, {
+    db.collection("user_violations").document(user_id).set({
+        "userId": user_id,
+        "violationCount": firestore.Increment(1),
+        "lastViolation": get_timestamp(),
+    }, merge=True)
+
+
+def write_moderation_batch(
+    log_entries: list[dict],
+    blocked_entries: list[dict],
+    violations: Counter
+) -> None:
+    """
+    Write moderation logs, blocked content and violation counts in batches.
+    
+    Used by validate_text, so a blocked message costs one commit instead
+    of three writes, and by bulk moderation, where one write per message
+    (plus one increment_user_violations write per violation) would
+    serialize N round trips. Violations are merged into one Increment(n)
+    per user.
+    
+    Args:
+        log_entries: moderation_logs documents (see moderation_event_data)
+        blocked_entries: blocked_content documents (see blocked_content_data)
+        violations: Number of new violations per user ID
+    """
+    db = get_firestore_client()
+    timestamp = get_timestamp()
+    
+    # (document, data, merge) for every write, committed 500 at a time
+    writes = [(db.collection("moderation_logs").document(), data, False) for data in log_entries]
+    writes += [(db.collection("blocked_content").document(), data, False) for data in blocked_entries]
+    writes += [
+        (db.collection("user_violations").document(user_id), {
             "userId": user_id,
-            "violationCount": new_count,
-            "lastViolation": get_timestamp(),
-        }, merge=True)
-        
-        return new_count
+            "violationCount": firestore.Increment(count),
+            "lastViolation": timestamp,
+        }, True)
+        for user_id, count in violations.items()
+    ]
     
-    transaction = db.transaction()
-    return update_in_transaction(transaction, doc_ref)
+    for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for doc_ref, data, merge in writes[start:start + FIRESTORE_BATCH_LIMIT]:
+            batch.set(doc_ref, data, merge=merge)
+        batch.commit()
 
 
 def parse_storage_path(path: str) -> tuple[str, str]: